@@ -0,0 +1,122 @@
+from time import monotonic
+import random
+
+class CircuitBreaker:
+    '''
+    Per-endpoint circuit breaker used to fast-fail calls to a dependency
+    (camera, Duet, cloud API) that is known to be unreachable.
+
+    States:
+        - closed : calls go through, consecutive failures are counted
+        - open : calls fail immediately until the backoff delay has elapsed
+        - half-open : a single trial call is let through. Success closes the
+        breaker, failure re-opens it with a longer delay
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(
+            self,
+            name : str = '',
+            failure_threshold : int = 3,
+            base_delay : float = 2.0,
+            max_delay : float = 300.0,
+            jitter : float = 0.2,
+            trial_timeout : float = 60.0
+        ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.trial_timeout = trial_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._opened_at = 0.0
+        self._retry_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.last_error = ''
+
+    def _backoff(self) -> float:
+        '''
+        Exponential backoff with jitter for the current number of trips
+
+        Returns:
+        - delay : float - seconds to stay open before allowing a trial call
+        '''
+        delay = min(self.max_delay, self.base_delay * (2 ** max(self._trips - 1, 0)))
+        return delay * (1.0 + random.uniform(-self.jitter, self.jitter))
+
+    def _open(self):
+        self._trips += 1
+        self.state = self.OPEN
+        self._opened_at = monotonic()
+        self._retry_at = self._opened_at + self._backoff()
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        '''
+        Checks if a call to the endpoint should be attempted.
+        Moves an open breaker to half-open once its delay has elapsed.
+        A trial that never reported back (e.g. its task was cancelled) is
+        given up after trial_timeout so the breaker can not stay stuck.
+
+        Returns:
+        - allowed : Boolean - whether the caller may contact the endpoint
+        '''
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and monotonic() >= self._retry_at:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN and self._trial_in_flight and monotonic() - self._trial_started > self.trial_timeout:
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            self._trial_started = monotonic()
+            return True
+        self.total_rejected += 1
+        return False
+
+    def release(self):
+        '''
+        Frees the trial slot of a call that ended without a result
+        (cancelled), without counting it as a success or a failure
+        '''
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._trial_in_flight = False
+
+    def record_failure(self, error : str = ''):
+        self._failures += 1
+        self.total_failures += 1
+        self.last_error = error
+        if self.state == self.OPEN:
+            # Late or forced calls failing while open do not extend the backoff
+            return
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            print("Circuit '{}' open: {}".format(self.name, error))
+            self._open()
+
+    def status(self) -> dict:
+        '''
+        Returns the breaker state for reporting in the monitor endpoint
+        '''
+        return {
+            'state' : self.state,
+            'failures' : self._failures,
+            'trips' : self._trips,
+            'retry_in' : round(max(self._retry_at - monotonic(), 0.0), 2) if self.state == self.OPEN else 0.0,
+            'total_failures' : self.total_failures,
+            'total_rejected' : self.total_rejected,
+            'last_error' : self.last_error
+        }
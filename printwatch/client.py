@@ -1,6 +1,8 @@
 import datetime
 import aiohttp
+import asyncio
 from uuid import uuid4
+from .breaker import CircuitBreaker
 
 class PrintWatchClient():
     '''
@@ -10,11 +12,16 @@ class PrintWatchClient():
             self,
             settings : dict,
             stream=None,
-            ssl : bool = True
+            ssl : bool = True,
+            route : str = None
         ):
-        self.route = 'https://ai.printpal.io' if ssl else 'http://ai.printpal.io'
+        if route is not None:
+            self.route = route
+        else:
+            self.route = 'https://ai.printpal.io' if ssl else 'http://ai.printpal.io'
         self.settings = settings
         self.ticket_id = ''
+        self.breaker = CircuitBreaker(name='cloud', base_delay=10.0, max_delay=600.0)
 
     def create_ticket(self):
         self.ticket_id = uuid4().hex
@@ -75,14 +82,25 @@ class PrintWatchClient():
                 payload
             ):
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                                '{}/{}'.format(self.route, endpoint),
-                                json = payload,
-                                headers={'User-Agent': 'Mozilla/5.0'},
-                                timeout=aiohttp.ClientTimeout(total=30.0)
-                            ) as response:
-                            r = await response.json()
+            if not self.breaker.allow():
+                return {'statusCode' : 503, 'response' : 'Circuit open for {}'.format(self.route)}
+
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(
+                                    '{}/{}'.format(self.route, endpoint),
+                                    json = payload,
+                                    headers={'User-Agent': 'Mozilla/5.0'},
+                                    timeout=aiohttp.ClientTimeout(total=30.0)
+                                ) as response:
+                                r = await response.json()
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                self.breaker.record_failure(str(e))
+                raise
+            self.breaker.record_success()
 
             self.response = r
             return r
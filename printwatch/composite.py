@@ -0,0 +1,139 @@
+import PIL.Image as Image
+import math
+
+def grid_shape(count : int) -> tuple:
+    '''
+    Returns the (columns, rows) of the most square grid that fits count tiles
+    '''
+    cols = int(math.ceil(math.sqrt(count)))
+    rows = int(math.ceil(count / cols))
+    return cols, rows
+
+def tile_images(
+        images : list,
+        max_side : int = 1920
+    ) -> tuple:
+    '''
+    Tiles several camera images into one composite image so they can be
+    sent in a single inference call.
+
+    Inputs:
+    - images : list - PIL images, one per camera
+    - max_side : int - maximum size of the longest side of the composite
+
+    Returns:
+    - composite : PIL.Image - the tiled image
+    - layout : list - [x, y, w, h] of each image in the composite, relative (0.0 - 1.0)
+    '''
+    cols, rows = grid_shape(len(images))
+    cell_w = max(img.size[0] for img in images)
+    cell_h = max(img.size[1] for img in images)
+    scale = min(1.0, max_side / max(cell_w * cols, cell_h * rows))
+    cell_w = int(cell_w * scale)
+    cell_h = int(cell_h * scale)
+    width = cell_w * cols
+    height = cell_h * rows
+
+    composite = Image.new('RGB', (width, height))
+    layout = []
+    for i, img in enumerate(images):
+        img = img.convert('RGB')
+        if img.size[0] > cell_w or img.size[1] > cell_h:
+            img.thumbnail((cell_w, cell_h))
+        x = (i % cols) * cell_w + (cell_w - img.size[0]) // 2
+        y = (i // cols) * cell_h + (cell_h - img.size[1]) // 2
+        composite.paste(img, (x, y))
+        layout.append([x / width, y / height, img.size[0] / width, img.size[1] / height])
+    return composite, layout
+
+def crop_regions(
+        img,
+        regions : list,
+        mask : bool = False
+    ) -> tuple:
+    '''
+    Crops an image to the bounding box of its regions of interest
+
+    Inputs:
+    - img : PIL.Image - the full camera frame
+    - regions : list - [x1, y1, x2, y2] regions relative to the frame (0.0 - 1.0)
+    - mask : bool - black out the parts of the crop that are outside every region
+
+    Returns:
+    - cropped : PIL.Image - the cropped image
+    - bounds : list - [x1, y1, x2, y2] of the crop relative to the frame
+    '''
+    width, height = img.size
+    bounds = [
+        max(0.0, min(r[0] for r in regions)),
+        max(0.0, min(r[1] for r in regions)),
+        min(1.0, max(r[2] for r in regions)),
+        min(1.0, max(r[3] for r in regions))
+    ]
+    box = (
+        int(bounds[0] * width),
+        int(bounds[1] * height),
+        max(int(bounds[0] * width) + 1, int(round(bounds[2] * width))),
+        max(int(bounds[1] * height) + 1, int(round(bounds[3] * height)))
+    )
+    cropped = img.crop(box)
+    if mask and len(regions) > 1:
+        masked = Image.new(cropped.mode, cropped.size)
+        for r in regions:
+            region_box = (
+                max(int(r[0] * width) - box[0], 0),
+                max(int(r[1] * height) - box[1], 0),
+                min(int(round(r[2] * width)) - box[0], cropped.size[0]),
+                min(int(round(r[3] * height)) - box[1], cropped.size[1])
+            )
+            masked.paste(cropped.crop(region_box), region_box[:2])
+        cropped = masked
+    bounds = [box[0] / width, box[1] / height, box[2] / width, box[3] / height]
+    return cropped, bounds
+
+def boxes_to_frame(boxes : list, bounds : list) -> list:
+    '''
+    Maps boxes relative to a crop back into full frame coordinates
+
+    Inputs:
+    - boxes : list - [x1, y1, x2, y2] boxes relative to the crop
+    - bounds : list - [x1, y1, x2, y2] of the crop relative to the frame
+
+    Returns:
+    - boxes : list - [x1, y1, x2, y2] boxes relative to the full frame
+    '''
+    w = bounds[2] - bounds[0]
+    h = bounds[3] - bounds[1]
+    return [[
+        bounds[0] + det[0] * w,
+        bounds[1] + det[1] * h,
+        bounds[0] + det[2] * w,
+        bounds[1] + det[3] * h
+    ] for det in boxes]
+
+def split_boxes(boxes : list, layout : list) -> list:
+    '''
+    Maps boxes found on a composite back to the frame they belong to.
+    A box is assigned to the tile that contains its centre and clipped to it.
+
+    Inputs:
+    - boxes : list - [x1, y1, x2, y2] boxes relative to the composite
+    - layout : list - tile rectangles as returned by tile_images
+
+    Returns:
+    - per_frame : list - one list of relative [x1, y1, x2, y2] boxes per frame
+    '''
+    per_frame = [[] for _ in layout]
+    for det in boxes:
+        cx = (det[0] + det[2]) / 2
+        cy = (det[1] + det[3]) / 2
+        for i, (x, y, w, h) in enumerate(layout):
+            if x <= cx <= x + w and y <= cy <= y + h:
+                per_frame[i].append([
+                    min(max((det[0] - x) / w, 0.0), 1.0),
+                    min(max((det[1] - y) / h, 0.0), 1.0),
+                    min(max((det[2] - x) / w, 0.0), 1.0),
+                    min(max((det[3] - y) / h, 0.0), 1.0)
+                ])
+                break
+    return per_frame
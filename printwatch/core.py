@@ -3,6 +3,14 @@ from fastapi.middleware.cors import CORSMiddleware
 from .client import *
 from .utils import *
 from .interface import *
+from .ratelimit import RATE_LIMITS
+from .preview import PreviewCache, PREVIEW_SIZES
+from .replay import SessionRecorder
+from .levels import LEVEL_SOURCES
+from .encoder import MODEL_SIZE, UPLOAD_QUALITY
+from .scheduler import InferenceScheduler, SCHEDULER_SETTINGS
+from .memory import MemoryProfiler, MEMORY_SETTINGS, memory_limits
+from .watchdog import LoopWatchdog, WATCHDOG_SETTINGS
 import asyncio
 import ujson
 import uvicorn
@@ -11,6 +19,7 @@ from pydantic import BaseModel
 from typing import Optional, Union
 from threading import Thread
 from contextlib import asynccontextmanager
+from copy import deepcopy
 
 origins = [
     "*",
@@ -25,6 +34,9 @@ class Settings(BaseModel):
     duet_ip : Optional[str] = None
     backendAddr : Optional[str] = None
     camera_ip : Optional[str] = None
+    cameras : Optional[list] = None
+    camera_roi : Optional[list] = None
+    camera_roi_mask : Optional[bool] = None
     email_addr : Optional[str] = None
     test_mode : Optional[bool] = None
     notification_threshold : Optional[float] = None
@@ -36,6 +48,15 @@ class Settings(BaseModel):
     cancel_action : Optional[bool] = None
     notify_action : Optional[bool] = None
     extruder_off_action : Optional[bool] = None
+    rate_limits : Optional[dict] = None
+    record_sessions : Optional[bool] = None
+    record_frames : Optional[bool] = None
+    level_source : Optional[str] = None
+    upload_size : Optional[int] = None
+    upload_quality : Optional[int] = None
+    scheduler : Optional[dict] = None
+    memory : Optional[dict] = None
+    watchdog : Optional[dict] = None
 
 
 def get_or_create_eventloop():
@@ -61,9 +82,17 @@ class PrintFarmPro:
         '''
         self.rep_rap_api = RepRapAPI()
         self.runner = None
+        self.inference_scheduler = None
+        self.preview_cache = PreviewCache()
+        self.memory_profiler = MemoryProfiler()
         self._load_settings()
         self.printwatch = PrintWatchClient(settings=self.settings)
         self.aio = get_or_create_eventloop()
+        watchdog = dict(WATCHDOG_SETTINGS)
+        watchdog.update(self.settings.get("watchdog") or {})
+        self.watchdog = LoopWatchdog(self.aio, **watchdog)
+        if watchdog.get("enabled"):
+            self.watchdog.start()
 
         if self.settings.get("monitoring_on"):
             self._init_monitor()
@@ -78,6 +107,7 @@ class PrintFarmPro:
         self.router.add_api_route('/machine/printwatch/monitor_init', self._add_monitor, methods=["GET"])
         self.router.add_api_route('/machine/printwatch/monitor_off', self._kill_monitor, methods=["GET"])
         self.router.add_api_route('/machine/printwatch/heartbeat', self._heartbeat, methods=["GET"])
+        self.router.add_api_route('/machine/printwatch/debug/memory', self._get_memory, methods=["GET"])
         self._init_api(self.aio)
 
         #self.aio = get_or_create_eventloop()
@@ -104,9 +134,51 @@ class PrintFarmPro:
         if True:
             self.rep_rap_api._get_uid()
             self.settings["printer_id"] = self.rep_rap_api.uniqueId
+        self._apply_memory_budget()
         if self.runner is not None:
             self.runner._loop_handler.resize_buffers()
-            self.runner._loop_handler.camera.ip = self.settings.get("camera_ip")
+            self.runner._loop_handler.configure_limits()
+            self.runner._loop_handler.set_cameras(self._build_cameras())
+
+    def _apply_memory_budget(self):
+        '''
+        Caps the preview cache and the history lengths to the memory budget and
+        starts or stops the tracemalloc profiler.
+        '''
+        limits = memory_limits(self.settings)
+        self.preview_cache.memory_budget = limits['preview_bytes']
+        if self.settings.get("buffer_length", 0) > limits['max_buffer_length']:
+            print("buffer_length capped to {} by the memory budget".format(limits['max_buffer_length']))
+            self.settings["buffer_length"] = limits['max_buffer_length']
+        memory = self.settings.get("memory") or {}
+        if memory.get("debug"):
+            self.memory_profiler.start(memory.get("traceback_frames", 1))
+        else:
+            self.memory_profiler.stop()
+
+    def _build_cameras(self) -> list:
+        '''
+        Builds the camera objects from the settings. The 'cameras' list
+        ([{"id" : ..., "ip" : ..., "roi" : [[x, y, w, h]], "roi_mask" : false}])
+        takes precedence over the single camera_ip / camera_roi.
+        Regions are relative to the frame (0.0 - 1.0).
+        '''
+        cameras = [
+            MJPEG(
+                id=str(camera.get("id", idx)),
+                ip=camera.get("ip", ""),
+                roi=camera.get("roi"),
+                roi_mask=camera.get("roi_mask", False)
+            )
+            for idx, camera in enumerate(self.settings.get("cameras") or [])
+        ]
+        if len(cameras) == 0:
+            cameras = [MJPEG(
+                ip=self.settings.get("camera_ip"),
+                roi=self.settings.get("camera_roi"),
+                roi_mask=self.settings.get("camera_roi_mask", False)
+            )]
+        return cameras
 
     def _save_settings(self):
         with open("settings.json", "w") as f:
@@ -135,7 +207,16 @@ class PrintFarmPro:
                     "notify" : False,
                     "extruder_off" : False,
                     "macro" : False
-                }
+                },
+                "rate_limits" : deepcopy(RATE_LIMITS),
+                "record_sessions" : False,
+                "record_frames" : False,
+                "level_source" : "server",
+                "upload_size" : MODEL_SIZE,
+                "upload_quality" : UPLOAD_QUALITY,
+                "scheduler" : deepcopy(SCHEDULER_SETTINGS),
+                "memory" : deepcopy(MEMORY_SETTINGS),
+                "watchdog" : deepcopy(WATCHDOG_SETTINGS)
             }
             self._on_settings_change()
             self._save_settings()
@@ -152,9 +233,18 @@ class PrintFarmPro:
                         settings=self.settings,
                         api_client=self.printwatch,
                         rep_rap_api=self.rep_rap_api,
-                        camera=MJPEG(ip=self.settings.get("camera_ip"))
+                        camera=self._build_cameras(),
+                        preview_cache=self.preview_cache,
+                        recorder=SessionRecorder(record_frames=self.settings.get("record_frames", False)) if self.settings.get("record_sessions") else None
                     )
-        self.runner = Scheduler(interval=10.0, loop_handler=loop)
+        scheduling = dict(SCHEDULER_SETTINGS)
+        scheduling.update(self.settings.get("scheduler") or {})
+        if scheduling.get("adaptive"):
+            if self.inference_scheduler is None:
+                self.inference_scheduler = InferenceScheduler(**scheduling)
+            self.runner = self.inference_scheduler.add(loop, name=self.settings.get("printer_id"))
+        else:
+            self.runner = Scheduler(interval=10.0, loop_handler=loop)
         self.settings["monitoring_on"] = True
         self._save_settings()
         self._on_settings_change()
@@ -162,6 +252,8 @@ class PrintFarmPro:
 
     def _kill_runner(self):
         self.runner.cancel()
+        if self.runner._loop_handler.recorder is not None:
+            self.runner._loop_handler.recorder.close()
         self.runner = None
         self.settings["monitoring_on"] = False
         self._save_settings()
@@ -175,22 +267,58 @@ class PrintFarmPro:
                     {'status' :
                         {'scores' : self.runner._loop_handler._scores,
                         'levels' : self.runner._loop_handler._levels,
-                        'buffer' : self.runner._loop_handler._buffer
+                        'buffer' : self.runner._loop_handler._buffer,
+                        'rate_limits' : self.runner._loop_handler._limiter.status(),
+                        'local_levels' : self.runner._loop_handler.level_engine.status()
+                        },
+                    'action_latency' :
+                        {'dispatch' : self.runner._loop_handler.action_latency['dispatch'].status(),
+                        'confirmed' : self.runner._loop_handler.action_latency['confirmed'].status(),
+                        'unconfirmed' : self.runner._loop_handler.action_unconfirmed,
+                        'failed' : self.runner._loop_handler.action_failed
+                        },
+                    'scheduler' : self.inference_scheduler.status() if self.inference_scheduler is not None else None,
+                    'event_loop' : self.watchdog.status(),
+                    'breakers' :
+                        {'camera' : self.runner._loop_handler.camera.breaker.status(),
+                        'cameras' : {camera.id : camera.breaker.status() for camera in self.runner._loop_handler.cameras},
+                        'duet' : self.rep_rap_api.breaker.status(),
+                        'cloud' : self.printwatch.breaker.status()
                         }
                     }
                 }
 
-    async def _get_preview(self):
+    async def _get_preview(self, size : str = 'full', camera : Optional[str] = None):
         if self.runner is None:
             return {'status' : 8001, 'response' : 'No monitor active'}
+        if size not in PREVIEW_SIZES:
+            return {'status' : 8001, 'response' : 'Unknown preview size, expected one of {}'.format(list(PREVIEW_SIZES))}
+        loop_handler = self.runner._loop_handler
+        source = loop_handler.camera
+        if camera is not None:
+            matches = [c for c in loop_handler.cameras if c.id == camera]
+            if len(matches) == 0:
+                return {'status' : 8001, 'response' : 'Unknown camera {}'.format(camera)}
+            source = matches[0]
         return {'status' : 8000,
                 'items' :
                     {'status' :
-                        {'preview' : self.runner._loop_handler.currentPreview
+                        {'preview' : await self.preview_cache.get(loop_handler.preview_key_for(source), size),
+                        'size' : size,
+                        'camera' : source.id,
+                        'cameras' : [c.id for c in loop_handler.cameras]
                         }
                     }
                 }
 
+    async def _get_memory(self, limit : int = 10, baseline : bool = False):
+        if not (self.settings.get("memory") or {}).get("debug"):
+            return {'status' : 8001, 'response' : 'Memory debugging is off, enable memory.debug in the settings'}
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(None, self.memory_profiler.report, limit, baseline)
+        report['preview_cache'] = self.preview_cache.status()
+        return {'status' : 8000, 'memory' : report}
+
     async def _heartbeat(self, api_key : str, test_mode : bool, enable_monitor : bool, duet_ip : str):
         unsynced_variables = {
             'duet_ip' : False,
@@ -227,6 +355,9 @@ class PrintFarmPro:
 
 
     async def _change_settings(self, settings : Settings):
+        # Validate before anything is applied so a rejected request changes nothing
+        if settings.level_source is not None and settings.level_source not in LEVEL_SOURCES:
+            return {'status' : 8001, 'response' : 'level_source must be one of {}'.format(LEVEL_SOURCES)}
         for key, value in settings.__dict__.items():
             if value is not None:
                 if key == 'notification_threshold':
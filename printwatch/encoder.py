@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+'''
+Encoder stage between capture and inference upload: crops frames to their
+regions of interest, tiles several cameras, downscales to the model input
+size and re-encodes as JPEG.
+
+Benchmark bytes uploaded and latency against the raw path with:
+    python3 -m printwatch.encoder --bench frame.jpg --uplink 5
+'''
+from .composite import tile_images, crop_regions, grid_shape
+import PIL.Image as Image
+from base64 import b64encode
+from io import BytesIO
+from time import perf_counter
+import argparse
+
+MODEL_SIZE = 640 # input resolution of the PrintWatch model, boxes are returned in this space
+UPLOAD_QUALITY = 85
+
+def _decode(frame : bytes, target : int, crop : list = None):
+    '''
+    Opens a frame using libjpeg DCT-domain scaling so that the (cropped)
+    content is decoded at no less than target pixels on its longest side.
+
+    Inputs:
+    - frame : bytes - encoded camera frame
+    - target : int - required size of the longest side after cropping, None for full resolution
+    - crop : list - relative [x1, y1, x2, y2] bounds of the crop, None for the full frame
+
+    Returns:
+    - img : PIL.Image - the decoded image
+    '''
+    img = Image.open(BytesIO(frame))
+    if target is not None:
+        crop = crop if crop is not None else [0.0, 0.0, 1.0, 1.0]
+        # Longest side of the crop in pixels, measured on each axis of the frame
+        longest = max((crop[2] - crop[0]) * img.size[0], (crop[3] - crop[1]) * img.size[1], 1.0)
+        scale = min(1.0, target / longest)
+        img.draft('RGB', (int(img.size[0] * scale) + 1, int(img.size[1] * scale) + 1))
+    return img
+
+def _region_bounds(regions : list) -> list:
+    return [
+        min(r[0] for r in regions),
+        min(r[1] for r in regions),
+        max(r[2] for r in regions),
+        max(r[3] for r in regions)
+    ]
+
+def prepare_upload(
+        frames : list,
+        regions : list = None,
+        masks : list = None,
+        size : int = MODEL_SIZE,
+        quality : int = UPLOAD_QUALITY,
+        max_side : int = 1920
+    ) -> tuple:
+    '''
+    Builds the image sent for inference from the captured frames: crops each
+    frame to its regions of interest, tiles several cameras into one image,
+    resizes to the model input size and re-encodes it.
+    A single frame without regions and with resizing disabled is passed through untouched.
+
+    Inputs:
+    - frames : list - encoded frames (bytes), one per camera
+    - regions : list - per frame list of relative [x1, y1, x2, y2] regions, or None
+    - masks : list - per frame flag to mask outside the regions
+    - size : int - longest side of the uploaded image, None or 0 keeps the capture resolution
+    - quality : int - JPEG quality of re-encoded images
+    - max_side : int - maximum size of the longest side of a composite when not resizing
+
+    Returns:
+    - image : bytes - encoded image to upload
+    - layout : list - tile rectangles of the composite, None for a single frame
+    - bounds : list - per frame crop bounds, None where the frame was not cropped
+    '''
+    size = size or None
+    regions = regions if regions is not None else [None] * len(frames)
+    masks = masks if masks is not None else [False] * len(frames)
+    if len(frames) == 1 and not regions[0] and size is None:
+        return frames[0], None, [None]
+
+    cols, rows = grid_shape(len(frames))
+    target = size // max(cols, rows) if size is not None else None
+    images = []
+    bounds = []
+    for frame, frame_regions, mask in zip(frames, regions, masks):
+        img = _decode(frame, target, _region_bounds(frame_regions) if frame_regions else None)
+        if frame_regions:
+            img, frame_bounds = crop_regions(img, frame_regions, mask)
+        else:
+            frame_bounds = None
+        images.append(img)
+        bounds.append(frame_bounds)
+
+    if len(images) == 1:
+        composite = images[0].convert('RGB')
+        layout = None
+    else:
+        composite, layout = tile_images(images, max_side=size if size is not None else max_side)
+
+    if size is not None and max(composite.size) > size:
+        scale = size / max(composite.size)
+        composite = composite.resize(
+                        (max(1, int(round(composite.size[0] * scale))), max(1, int(round(composite.size[1] * scale)))),
+                        Image.BILINEAR
+                    )
+
+    out_img = BytesIO()
+    composite.save(out_img, format='JPEG', quality=quality)
+    return out_img.getvalue(), layout, bounds
+
+
+def benchmark(
+        frame : bytes,
+        size : int = MODEL_SIZE,
+        quality : int = UPLOAD_QUALITY,
+        uplink_mbps : float = 5.0,
+        repeat : int = 20
+    ) -> dict:
+    '''
+    Compares the raw upload path with the encoder stage
+
+    Inputs:
+    - frame : bytes - a captured JPEG frame
+    - size : int - encoder output size
+    - quality : int - encoder JPEG quality
+    - uplink_mbps : float - uplink bandwidth used to estimate transfer time
+    - repeat : int - number of encodes to average
+
+    Returns:
+    - results : dict - payload bytes, encode time and estimated end-to-end upload latency per path
+    '''
+    results = {}
+    for name, kwargs in [('raw', {'size' : None}), ('encoded', {'size' : size, 'quality' : quality})]:
+        start = perf_counter()
+        for _ in range(repeat):
+            image, _, _ = prepare_upload([frame], **kwargs)
+            payload = b64encode(image)
+        encode_ms = 1e3 * (perf_counter() - start) / repeat
+        transfer_ms = 1e3 * len(payload) * 8 / (uplink_mbps * 1e6)
+        results[name] = {
+            'image_bytes' : len(image),
+            'payload_bytes' : len(payload),
+            'encode_ms' : encode_ms,
+            'transfer_ms' : transfer_ms,
+            'latency_ms' : encode_ms + transfer_ms
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PrintWatch upload encoder')
+    parser.add_argument('--bench', type=str, default=None, help='JPEG frame to benchmark with')
+    parser.add_argument('--size', type=int, default=MODEL_SIZE)
+    parser.add_argument('--quality', type=int, default=UPLOAD_QUALITY)
+    parser.add_argument('--uplink', type=float, default=5.0, help='uplink bandwidth in Mbit/s')
+    args = parser.parse_args()
+    if args.bench is not None:
+        with open(args.bench, 'rb') as f:
+            frame = f.read()
+        for name, result in benchmark(frame, args.size, args.quality, args.uplink).items():
+            print('{:>8} | {:>9} bytes uploaded | encode {:>7.2f} ms | transfer {:>8.2f} ms | total {:>8.2f} ms'.format(
+                name,
+                result['payload_bytes'],
+                result['encode_ms'],
+                result['transfer_ms'],
+                result['latency_ms']
+            ))
@@ -2,38 +2,64 @@ import PIL.Image as Image
 from io import BytesIO
 import urllib3
 import aiohttp
+import asyncio
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 import requests
+from .breaker import CircuitBreaker
 
 class MJPEG:
     def __init__(
             self,
             id : str = '',
-            ip : str = ''
+            ip : str = '',
+            roi : list = None,
+            roi_mask : bool = False
         ):
         self.id = id
         self.ip = ip
+        self.roi = roi or [] # [x, y, w, h] regions relative to the frame
+        self.roi_mask = roi_mask
         self.frame = None
         self.cap = None
         self.byte_frame = None
         self.pil_image = None
+        self.breaker = CircuitBreaker(name='camera')
 
     async def snap(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                            '{}'.format(
-                                self.ip
-                            ),
-                            timeout=aiohttp.ClientTimeout(total=5.0)
-                        ) as response:
-                        if response.status == 200:
-                            self.byte_frame = await response.read()
-                            return self.byte_frame
+        if not self.breaker.allow():
+            return False
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(
+                                '{}'.format(
+                                    self.ip
+                                ),
+                                timeout=aiohttp.ClientTimeout(total=5.0)
+                            ) as response:
+                            if response.status == 200:
+                                self.byte_frame = await response.read()
+                                self.breaker.record_success()
+                                return self.byte_frame
+                            self.breaker.record_failure('HTTP {}'.format(response.status))
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self.breaker.record_failure(str(e))
 
         return False
-        self.pil_image = Image.open(BytesIO(self.byte_frame))
+
     def snap_sync(self):
-        r = requests.get(self.ip)
+        if not self.breaker.allow():
+            return False
+        try:
+            r = requests.get(self.ip, timeout=5.0)
+        except Exception as e:
+            self.breaker.record_failure(str(e))
+            return False
         if r.status_code == 200:
             self.byte_frame = r.content
+            self.breaker.record_success()
             return r.content
+        self.breaker.record_failure('HTTP {}'.format(r.status_code))
+        return False
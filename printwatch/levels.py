@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+'''
+Local computation of the moving averages and notification/action levels
+from the scores history, mirroring the fields returned by the PrintWatch API.
+
+Benchmark the per-update cost with:
+    python3 -m printwatch.levels --bench
+'''
+from time import perf_counter
+import argparse
+import numpy as np
+
+LEVEL_SOURCES = ['server', 'local', 'both']
+
+class LevelEngine:
+    '''
+    Keeps the scores in a fixed size ring buffer and evaluates the levels with
+    vectorised NumPy operations.
+
+    The SMA at each step is the mean of the last buffer_length scores. A level
+    is raised when at least buffer_percent of the last buffer_length SMAs are
+    above its threshold.
+    '''
+    def __init__(
+            self,
+            settings : dict,
+            MULTIPLIER : float = 4.0
+        ):
+        self.settings = settings
+        self.MULTIPLIER = MULTIPLIER
+        self.levels = [False, False] # Corresponds to [Notify, Action]
+        self.sma = 0.0
+        self.agree = 0
+        self.disagree = 0
+        self.configure()
+
+    def configure(self):
+        '''
+        Resizes the history to the current settings, keeping the most recent scores
+        '''
+        self.length = max(1, int(self.settings.get("buffer_length")))
+        size = max(2 * self.length, int(self.length * self.MULTIPLIER))
+        history = self.history() if hasattr(self, '_ring') else np.zeros(0)
+        # Each score is written twice so the last `size` scores are always a contiguous view
+        self.size = size
+        self._ring = np.zeros(2 * size, dtype=np.float64)
+        self._pos = 0
+        for score in history[-size:]:
+            self._push(score)
+        percent = self.settings.get("buffer_percent")
+        self.percent = percent / 100.0 if percent > 1.0 else percent
+        thresholds = self.settings.get("thresholds", {})
+        self.thresholds = np.array([thresholds.get("notification", 0.3), thresholds.get("action", 0.6)])
+
+    def reset(self):
+        self._ring[:] = 0.0
+        self._pos = 0
+        self.levels = [False, False]
+        self.sma = 0.0
+
+    def _push(self, score : float):
+        self._ring[self._pos] = score
+        self._ring[self._pos + self.size] = score
+        self._pos = (self._pos + 1) % self.size
+
+    def history(self) -> np.ndarray:
+        return self._ring[self._pos:self._pos + self.size]
+
+    def compute(self, scores : np.ndarray) -> tuple:
+        '''
+        Evaluates the SMAs and levels of a scores history
+
+        Inputs:
+        - scores : np.ndarray - scores, oldest first
+
+        Returns:
+        - smas : np.ndarray - moving average at each of the last buffer_length steps
+        - levels : list - [notify, action] flags
+        '''
+        length = self.length
+        cumsum = np.cumsum(np.concatenate(([0.0], scores[-(2 * length - 1):])))
+        smas = (cumsum[length:] - cumsum[:-length]) / length
+        fraction_above = (smas[:, None] >= self.thresholds[None, :]).mean(axis=0)
+        levels = (fraction_above >= self.percent).tolist()
+        return smas, levels
+
+    def update(self, score : float) -> list:
+        '''
+        Adds a score and re-evaluates the levels
+
+        Inputs:
+        - score : float - the latest score
+
+        Returns:
+        - levels : list - [notify, action] flags
+        '''
+        self._push(score if score is not None else 0.0)
+        smas, self.levels = self.compute(self.history())
+        self.sma = float(smas[-1])
+        return self.levels
+
+    def cross_check(self, server_levels : list) -> bool:
+        '''
+        Compares the local levels against the levels returned by the server
+
+        Inputs:
+        - server_levels : list - [notify, action] flags from the API
+
+        Returns:
+        - agree : Boolean - whether both sides raised the same levels
+        '''
+        agree = [bool(l) for l in server_levels] == self.levels
+        if agree:
+            self.agree += 1
+        else:
+            self.disagree += 1
+        return agree
+
+    def status(self) -> dict:
+        return {
+            'sma' : self.sma,
+            'levels' : self.levels,
+            'agree' : self.agree,
+            'disagree' : self.disagree
+        }
+
+
+def benchmark(sizes : list = [16, 64, 256, 1024, 4096, 16384, 65536], updates : int = 2000) -> dict:
+    '''
+    Measures the per-update cost of the level engine for several buffer lengths
+
+    Returns:
+    - results : dict - mean microseconds per update for each buffer length
+    '''
+    results = {}
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        engine = LevelEngine({
+            "buffer_length" : size,
+            "buffer_percent" : 60,
+            "thresholds" : {"notification" : 0.3, "action" : 0.6}
+        })
+        scores = rng.random(updates).tolist()
+        start = perf_counter()
+        for score in scores:
+            engine.update(score)
+        results[size] = 1e6 * (perf_counter() - start) / updates
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PrintWatch local level engine')
+    parser.add_argument('--bench', action='store_true', help='benchmark the per-update cost')
+    parser.add_argument('--updates', type=int, default=2000)
+    args = parser.parse_args()
+    if args.bench:
+        for size, cost in benchmark(updates=args.updates).items():
+            print('buffer_length {:>6} | {:>8.1f} us/update'.format(size, cost))
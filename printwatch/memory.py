@@ -0,0 +1,148 @@
+from collections import Counter
+import gc
+import os
+import tracemalloc
+
+MEMORY_SETTINGS = {
+    "budget_mb" : 32, # memory set aside for caches and histories
+    "preview_share" : 0.5, # part of the budget used by the preview cache, the rest caps the histories
+    "debug" : False, # enables tracemalloc and the debug/memory route
+    "traceback_frames" : 1
+}
+
+# Approximate bytes held per unit of buffer_length: one [score, sma, level]
+# entry in the buffer, MULTIPLIER (4) score floats and the level engine ring
+HISTORY_BYTES_PER_ENTRY = 384
+
+def memory_limits(settings : dict) -> dict:
+    '''
+    Splits the memory budget between the preview cache and the histories
+
+    Inputs:
+    - settings : dict - the full settings
+
+    Returns:
+    - limits : dict - preview_bytes and max_buffer_length
+    '''
+    memory = dict(MEMORY_SETTINGS)
+    memory.update(settings.get("memory") or {})
+    budget = memory.get("budget_mb") * 1024 * 1024
+    preview_bytes = int(budget * memory.get("preview_share"))
+    return {
+        'preview_bytes' : preview_bytes,
+        'max_buffer_length' : max(1, int((budget - preview_bytes) // HISTORY_BYTES_PER_ENTRY))
+    }
+
+def rss_bytes() -> int:
+    '''
+    Returns the resident set size of the process, None if it can not be read
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return None
+
+def subsystem(filename : str) -> str:
+    '''
+    Maps a source file to the subsystem it belongs to: a printwatch module,
+    a third party package or the standard library
+    '''
+    parts = filename.replace('\\', '/').split('/')
+    if 'printwatch' in parts[:-1]:
+        return 'printwatch.' + os.path.splitext(parts[-1])[0]
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in parts:
+            idx = parts.index(marker)
+            if idx + 1 < len(parts):
+                return os.path.splitext(parts[idx + 1])[0]
+    return 'stdlib'
+
+
+class MemoryProfiler:
+    '''
+    Opt-in tracemalloc introspection for long running hosts. Reports the top
+    allocators, allocations per subsystem, growth since a baseline snapshot
+    and live object counts.
+    '''
+    def __init__(self):
+        self._baseline = None
+
+    @property
+    def running(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames : int = 1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._baseline = None
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._baseline = None
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ))
+
+    def report(self, limit : int = 10, baseline : bool = False) -> dict:
+        '''
+        Builds the memory report
+
+        Inputs:
+        - limit : int - number of top allocators and object types to list
+        - baseline : bool - store this snapshot as the baseline for growth
+
+        Returns:
+        - report : dict - memory usage summary
+        '''
+        report = {'rss' : rss_bytes(), 'tracing' : self.running}
+        if self.running:
+            snapshot = self._snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            report['traced'] = {'current' : current, 'peak' : peak}
+            report['top'] = [
+                {
+                    'location' : '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                    'size' : stat.size,
+                    'count' : stat.count
+                } for stat in snapshot.statistics('lineno')[:limit]
+            ]
+            per_subsystem = Counter()
+            for stat in snapshot.statistics('filename'):
+                per_subsystem[subsystem(stat.traceback[0].filename)] += stat.size
+            report['subsystems'] = dict(per_subsystem.most_common())
+            if self._baseline is not None:
+                report['growth'] = [
+                    {
+                        'location' : '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                        'size_diff' : stat.size_diff,
+                        'count_diff' : stat.count_diff
+                    } for stat in snapshot.compare_to(self._baseline, 'lineno')[:limit]
+                ]
+            if baseline or self._baseline is None:
+                self._baseline = snapshot
+
+        types = Counter()
+        printwatch_types = Counter()
+        for obj in gc.get_objects():
+            cls = type(obj)
+            types[cls.__name__] += 1
+            if cls.__module__.startswith('printwatch'):
+                printwatch_types['{}.{}'.format(cls.__module__, cls.__name__)] += 1
+        report['objects'] = {
+            'top' : dict(types.most_common(limit)),
+            'printwatch' : dict(printwatch_types.most_common())
+        }
+        return report
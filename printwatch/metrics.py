@@ -0,0 +1,63 @@
+from collections import deque
+
+def percentile(values, percent : float) -> float:
+    '''
+    Nearest-rank percentile of a collection of samples, None when empty
+    '''
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+class LatencyHistogram:
+    '''
+    Fixed-bucket latency histogram with percentiles over the most recent samples.
+    All values are in seconds.
+    '''
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    def __init__(
+            self,
+            buckets : list = None,
+            window : int = 256
+        ):
+        self.buckets = buckets if buckets is not None else self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1) # last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+        self._recent = deque(maxlen=window)
+
+    def observe(self, value : float):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+        self._recent.append(value)
+
+    def percentile(self, percent : float) -> float:
+        '''
+        Returns the given percentile of the recent samples, None when empty
+        '''
+        return percentile(self._recent, percent)
+
+    def status(self) -> dict:
+        buckets = {'le_{}'.format(bound) : count for bound, count in zip(self.buckets, self.counts)}
+        buckets['le_inf'] = self.counts[-1]
+        return {
+            'count' : self.count,
+            'mean' : self.total / self.count if self.count > 0 else None,
+            'p50' : self.percentile(50),
+            'p90' : self.percentile(90),
+            'p99' : self.percentile(99),
+            'max' : self.max,
+            'last' : self.last,
+            'buckets' : buckets
+        }
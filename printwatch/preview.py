@@ -0,0 +1,165 @@
+from PIL import ImageDraw
+import PIL.Image as Image
+from base64 import b64encode
+from collections import OrderedDict
+from io import BytesIO
+import asyncio
+
+# Longest side in pixels for each preview variant, None keeps the frame size
+PREVIEW_SIZES = {
+    "thumbnail" : 200,
+    "medium" : 640,
+    "full" : None
+}
+
+class PreviewEntry:
+    '''
+    Latest frame and detections for one printer, plus the variants rendered from it
+    '''
+    def __init__(self, frame : bytes, boxes : list, sequence : int):
+        self.frame = frame
+        self.boxes = boxes
+        self.sequence = sequence
+        self.variants = {}
+
+    def nbytes(self) -> int:
+        return len(self.frame) + sum(len(v) for v in self.variants.values())
+
+
+def render_preview(frame : bytes, boxes : list, size : str = 'full') -> str:
+    '''
+    Renders a frame with its detection boxes as a data URI
+
+    Inputs:
+    - frame : bytes - encoded image as returned by the camera
+    - boxes : list - boxes as [x1, y1, x2, y2] relative to the frame (0.0 - 1.0)
+    - size : str - one of PREVIEW_SIZES
+
+    Returns:
+    - preview : str - base64 data URI. PNG for full size, JPEG for reduced sizes
+    '''
+    max_side = PREVIEW_SIZES[size]
+    pil_img = Image.open(BytesIO(frame))
+    if max_side is not None:
+        # JPEG frames are decoded at a reduced DCT scale, other formats ignore this
+        pil_img.draft('RGB', (max_side, max_side))
+        pil_img = pil_img.convert('RGB')
+        pil_img.thumbnail((max_side, max_side))
+    process_image = ImageDraw.Draw(pil_img)
+    width, height = pil_img.size
+    line_width = max(1, int(round(4 * max(width, height) / 1280)))
+
+    for det in boxes:
+        x1 = det[0] * width
+        y1 = det[1] * height
+        x2 = det[2] * width
+        y2 = det[3] * height
+        process_image.rectangle([(x1, y1), (x2, y2)], fill=None, outline="red", width=line_width)
+
+    out_img = BytesIO()
+    if max_side is None:
+        pil_img.save(out_img, format='PNG')
+        mime = 'image/png'
+    else:
+        pil_img.save(out_img, format='JPEG', quality=80)
+        mime = 'image/jpeg'
+    contents = b64encode(out_img.getvalue()).decode('utf8')
+    return 'data:{};charset=utf-8;base64,'.format(mime) + contents
+
+
+class PreviewCache:
+    '''
+    Keeps the latest frame per printer and renders preview variants on demand.
+    Variants of an older frame are dropped as soon as a new frame arrives and
+    the least recently used data is evicted once the memory budget is exceeded.
+    '''
+    def __init__(
+            self,
+            memory_budget : int = 16 * 1024 * 1024
+        ):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._sequence = 0
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, key : str, frame : bytes, boxes : list) -> int:
+        '''
+        Stores a new frame for a printer, invalidating its rendered variants
+
+        Inputs:
+        - key : str - printer the frame belongs to
+        - frame : bytes - encoded camera frame
+        - boxes : list - relative [x1, y1, x2, y2] boxes to draw
+
+        Returns:
+        - sequence : int - sequence number of the stored frame
+        '''
+        self._sequence += 1
+        self._entries[key] = PreviewEntry(frame, boxes, self._sequence)
+        self._entries.move_to_end(key)
+        self._evict()
+        return self._sequence
+
+    def _store(self, key : str, sequence : int, size : str, preview : str):
+        entry = self._entries.get(key)
+        if entry is None or entry.sequence != sequence:
+            # A newer frame arrived while rendering
+            return
+        entry.variants[size] = preview
+        self._entries.move_to_end(key)
+        self._evict(keep=key)
+
+    def nbytes(self) -> int:
+        return sum(entry.nbytes() for entry in self._entries.values())
+
+    def _evict(self, keep : str = None):
+        total = self.nbytes()
+        # Drop rendered variants first, oldest printers first
+        for key, entry in self._entries.items():
+            if total <= self.memory_budget:
+                return
+            if key == keep:
+                continue
+            for size in list(entry.variants):
+                total -= len(entry.variants.pop(size))
+        # Then whole frames, never the most recent one
+        while total > self.memory_budget and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                key, entry = next(iter(self._entries.items()))
+            total -= entry.nbytes()
+            del self._entries[key]
+
+    async def get(self, key : str, size : str = 'full') -> str:
+        '''
+        Returns the preview variant for a printer, rendering it off the event loop if needed
+
+        Inputs:
+        - key : str - printer to get the preview for
+        - size : str - one of PREVIEW_SIZES
+
+        Returns:
+        - preview : str - base64 data URI, None if no frame has been captured
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if size in entry.variants:
+            self.hits += 1
+            return entry.variants[size]
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        preview = await loop.run_in_executor(None, render_preview, entry.frame, entry.boxes, size)
+        self._store(key, entry.sequence, size, preview)
+        return preview
+
+    def status(self) -> dict:
+        return {
+            'entries' : len(self._entries),
+            'bytes' : self.nbytes(),
+            'memory_budget' : self.memory_budget,
+            'hits' : self.hits,
+            'misses' : self.misses
+        }
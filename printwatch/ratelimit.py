@@ -0,0 +1,270 @@
+from time import time
+import ujson
+import os
+
+RATE_LIMITS = {
+    "notify" : {
+        "min_interval" : 10.0 * 60.0, # 10 minutes between notifications minimum
+        "window" : 4.0 * 60.0 * 60.0,
+        "max_in_window" : 2,
+        "max_total" : 10
+    },
+    "action" : {
+        "min_interval" : 10.0 * 60.0,
+        "window" : 4.0 * 60.0 * 60.0,
+        "max_in_window" : 10,
+        "max_total" : 10
+    }
+}
+
+class TokenBucket:
+    '''
+    Token bucket that refills one token every refill_interval seconds up to capacity.
+    A capacity of 1 acts as a minimum interval between events.
+    '''
+    def __init__(
+            self,
+            capacity : int = 1,
+            refill_interval : float = 600.0
+        ):
+        self.capacity = capacity
+        self.refill_interval = refill_interval
+        self.tokens = float(capacity)
+        self.updated = 0.0
+
+    def _refill(self, now : float):
+        if now > self.updated and self.refill_interval > 0:
+            self.tokens = min(float(self.capacity), self.tokens + (now - self.updated) / self.refill_interval)
+        elif self.refill_interval <= 0:
+            self.tokens = float(self.capacity)
+        self.updated = max(now, self.updated)
+
+    def available(self, now : float = None) -> bool:
+        self._refill(time() if now is None else now)
+        return self.tokens >= 1.0
+
+    def consume(self, now : float = None) -> bool:
+        if not self.available(now):
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def state(self) -> dict:
+        return {'tokens' : self.tokens, 'updated' : self.updated}
+
+    def load_state(self, state : dict):
+        self.tokens = min(float(self.capacity), float(state.get('tokens', self.capacity)))
+        self.updated = float(state.get('updated', 0.0))
+
+
+class SlidingWindowCounter:
+    '''
+    Counts events over the last `window` seconds using a fixed ring of buckets,
+    so memory and the cost of a check stay constant however long the process runs.
+    '''
+    def __init__(
+            self,
+            window : float = 4.0 * 60.0 * 60.0,
+            buckets : int = 24
+        ):
+        self.window = window
+        self.buckets = buckets
+        self.width = window / buckets
+        self._counts = [0] * buckets
+        self._head = 0 # absolute index of the most recent bucket
+        self._total = 0
+
+    def _advance(self, now : float):
+        index = int(now // self.width)
+        if index <= self._head:
+            return
+        if index - self._head >= self.buckets:
+            self._counts = [0] * self.buckets
+            self._total = 0
+        else:
+            for i in range(self._head + 1, index + 1):
+                slot = i % self.buckets
+                self._total -= self._counts[slot]
+                self._counts[slot] = 0
+        self._head = index
+
+    def count(self, now : float = None) -> int:
+        self._advance(time() if now is None else now)
+        return self._total
+
+    def add(self, now : float = None):
+        now = time() if now is None else now
+        self._advance(now)
+        self._counts[self._head % self.buckets] += 1
+        self._total += 1
+
+    def state(self) -> dict:
+        return {'counts' : self._counts, 'head' : self._head, 'width' : self.width}
+
+    def load_state(self, state : dict):
+        counts = state.get('counts', [])
+        if len(counts) != self.buckets or state.get('width') != self.width:
+            return
+        self._counts = [int(c) for c in counts]
+        self._head = int(state.get('head', 0))
+        self._total = sum(self._counts)
+
+
+class TriggerLimiter:
+    '''
+    Rate limit for one trigger type (notify, action). Combines a minimum
+    interval (token bucket), a maximum count inside a sliding window and
+    a cap per print. The cap is only held in memory, it is cleared by reset()
+    and on restart.
+    '''
+    def __init__(
+            self,
+            min_interval : float = 600.0,
+            window : float = 4.0 * 60.0 * 60.0,
+            max_in_window : int = 2,
+            max_total : int = 10
+        ):
+        self.bucket = TokenBucket(capacity=1, refill_interval=min_interval)
+        self.window = SlidingWindowCounter(window=window)
+        self.max_in_window = max_in_window
+        self.max_total = max_total
+        self.total = 0
+        self.last = 0.0
+
+    @classmethod
+    def from_config(cls, config : dict):
+        return cls(
+            min_interval=config.get("min_interval"),
+            window=config.get("window"),
+            max_in_window=config.get("max_in_window"),
+            max_total=config.get("max_total")
+        )
+
+    def exhausted(self) -> bool:
+        return self.total >= self.max_total
+
+    def allow(self, now : float = None) -> bool:
+        '''
+        Checks if the trigger is permitted without consuming it
+
+        Inputs:
+        - now : float - timestamp to evaluate at, defaults to time()
+
+        Returns:
+        - valid : Boolean - whether the trigger should be allowed
+        '''
+        now = time() if now is None else now
+        if self.exhausted():
+            return False
+        if self.window.count(now) >= self.max_in_window:
+            return False
+        return self.bucket.available(now)
+
+    def record(self, now : float = None):
+        '''
+        Records that the trigger fired
+        '''
+        now = time() if now is None else now
+        self.bucket.consume(now)
+        self.window.add(now)
+        self.total += 1
+        self.last = now
+
+    def reset(self):
+        self.total = 0
+
+    def state(self) -> dict:
+        '''
+        Returns the state that is persisted across restarts, the per print total is not
+        '''
+        return {
+            'bucket' : self.bucket.state(),
+            'window' : self.window.state(),
+            'last' : self.last
+        }
+
+    def load_state(self, state : dict):
+        self.bucket.load_state(state.get('bucket', {}))
+        self.window.load_state(state.get('window', {}))
+        self.last = float(state.get('last', 0.0))
+
+
+class RateLimiter:
+    '''
+    Holds one TriggerLimiter per trigger type, configured from the
+    `rate_limits` settings entry and persisted to disk across restarts.
+    '''
+    def __init__(
+            self,
+            config : dict = None,
+            path : str = "rate_limits.json",
+            clock = time
+        ):
+        self.path = path
+        self.clock = clock
+        self.limiters = {}
+        self.configure(config)
+        self.load()
+
+    def configure(self, config : dict = None):
+        '''
+        (Re)builds the limiters from the settings, keeping the current state.
+
+        Inputs:
+        - config : dict - per trigger overrides of RATE_LIMITS
+        '''
+        config = config or {}
+        for name, defaults in RATE_LIMITS.items():
+            merged = dict(defaults)
+            merged.update(config.get(name, {}))
+            limiter = TriggerLimiter.from_config(merged)
+            if name in self.limiters:
+                limiter.load_state(self.limiters[name].state())
+                limiter.total = self.limiters[name].total
+            self.limiters[name] = limiter
+
+    def __getitem__(self, name : str) -> TriggerLimiter:
+        return self.limiters[name]
+
+    def allow(self, name : str, now : float = None) -> bool:
+        return self.limiters[name].allow(self.clock() if now is None else now)
+
+    def record(self, name : str, now : float = None):
+        self.limiters[name].record(self.clock() if now is None else now)
+        self.save()
+
+    def reset(self):
+        '''
+        Clears the per print caps, called when a print ends
+        '''
+        for limiter in self.limiters.values():
+            limiter.reset()
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "w") as f:
+                ujson.dump({name : limiter.state() for name, limiter in self.limiters.items()}, f)
+        except Exception as e:
+            print("Error saving rate limits: {}".format(str(e)))
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                state = ujson.load(f)
+            for name, limiter in self.limiters.items():
+                limiter.load_state(state.get(name, {}))
+        except Exception as e:
+            print("Error loading rate limits: {}".format(str(e)))
+
+    def status(self) -> dict:
+        return {
+            name : {
+                'total' : limiter.total,
+                'in_window' : limiter.window.count(self.clock()),
+                'last' : limiter.last
+            } for name, limiter in self.limiters.items()
+        }
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+'''
+Record-and-replay harness for the LoopHandler decision path.
+
+The SessionRecorder writes one gzip'd JSON line per cycle (timestamp, Duet
+state, inference response and optionally the frame). replay_session feeds
+those records back through LoopHandler._handle_buffer / _handle_action with
+a virtual clock and stubbed clients, as fast as the CPU allows.
+
+Usage:
+    python3 -m printwatch.replay sessions/*.jsonl.gz --buffer_length 16 --buffer_percent 60
+'''
+from .client import PrintWatchClient
+from .interface import MJPEG
+from .utils import RepRapAPI, LoopHandler
+from .ratelimit import RateLimiter, RATE_LIMITS
+from .metrics import percentile
+from base64 import b64encode
+from copy import deepcopy
+from time import perf_counter, strftime
+import argparse
+import asyncio
+import gzip
+import ujson
+import glob
+import os
+import threading
+import zlib
+
+REPLAY_SETTINGS = {
+    "api_key" : "",
+    "printer_id" : "replay",
+    "test_mode" : False,
+    "thresholds" : {
+        "notification" : 0.3,
+        "action" : 0.6,
+        "display" : 0.6
+    },
+    "buffer_length" : 16,
+    "buffer_percent" : 60,
+    "actions": {
+        "pause" : True,
+        "cancel" : False,
+        "notify" : True,
+        "extruder_off" : False,
+        "macro" : False
+    },
+    "rate_limits" : RATE_LIMITS
+}
+
+class SessionRecorder:
+    '''
+    Records each monitoring cycle to a compact session file.
+    A new file is started for every print, i.e. after end_session() is called.
+    record() is meant to run in an executor, a lock keeps it from racing end_session().
+    '''
+    def __init__(
+            self,
+            directory : str = 'sessions',
+            record_frames : bool = False
+        ):
+        self.directory = directory
+        self.record_frames = record_frames
+        self.path = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, 'session-{}.jsonl.gz'.format(strftime('%Y%m%d-%H%M%S')))
+        self._file = gzip.open(self.path, 'at')
+
+    def record(
+            self,
+            now : float,
+            duet_state,
+            response : dict,
+            frame : bytes = None
+        ):
+        '''
+        Appends one cycle to the current session
+
+        Inputs:
+        - now : float - timestamp of the cycle
+        - duet_state : dict - RepRap firmware status response
+        - response : dict - inference response
+        - frame : bytes - the frame that was sent, only stored if record_frames is set
+        '''
+        try:
+            record = {'t' : now, 'duet_state' : duet_state, 'response' : response}
+            if self.record_frames and frame is not None:
+                record['frame'] = b64encode(frame).decode('utf8')
+            line = ujson.dumps(record) + '\n'
+            with self._lock:
+                if self._file is None:
+                    self._open()
+                self._file.write(line)
+        except Exception as e:
+            print("Error recording session: {}".format(str(e)))
+
+    def end_session(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    close = end_session
+
+
+def load_session(path : str) -> list:
+    '''
+    Loads the cycles of a recorded session. A session cut short by a
+    restart is read up to the last complete record.
+
+    Inputs:
+    - path : str - session file
+
+    Returns:
+    - records : list - recorded cycles in order
+    '''
+    records = []
+    try:
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                try:
+                    records.append(ujson.loads(line))
+                except ValueError:
+                    break
+    except (EOFError, OSError, zlib.error):
+        pass
+    return records
+
+
+class VirtualClock:
+    def __init__(self, start : float = 0.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def set(self, value : float):
+        self.now = max(self.now, value)
+
+
+class ReplayClient(PrintWatchClient):
+    '''
+    PrintWatchClient that records notifications instead of sending them
+    '''
+    def __init__(self, settings : dict, clock : VirtualClock):
+        super().__init__(settings=settings)
+        self.clock = clock
+        self.notifications = []
+
+    async def _send_async(self, endpoint, payload):
+        self.notifications.append((self.clock(), payload.get("notification")))
+        return {'statusCode' : 200}
+
+
+class ReplayRepRapAPI(RepRapAPI):
+    '''
+    RepRapAPI that records pause commands instead of sending them
+    '''
+    def __init__(self, clock : VirtualClock):
+        self.clock = clock
+        self.pauses = []
+        super().__init__(url='')
+
+    async def _pause_print(self, gcode : str = 'M25'):
+        self.pauses.append(self.clock())
+        return ''
+
+    async def _get_state(self, endpoint : str = '', status_type : int = 3, force : bool = False):
+        return {'status' : 'A' if len(self.pauses) > 0 else 'P'}
+
+
+async def replay_session(
+        records : list,
+        settings : dict = None
+    ) -> dict:
+    '''
+    Replays a recorded session through a fresh LoopHandler
+
+    Inputs:
+    - records : list - cycles as returned by load_session
+    - settings : dict - settings to evaluate, defaults to REPLAY_SETTINGS
+
+    Returns:
+    - result : dict - triggers fired and timing of the decision path
+    '''
+    settings = deepcopy(settings or REPLAY_SETTINGS)
+    clock = VirtualClock(records[0].get('t', 0.0) if len(records) > 0 else 0.0)
+    client = ReplayClient(settings, clock)
+    rep_rap_api = ReplayRepRapAPI(clock)
+    handler = LoopHandler(
+                    settings=settings,
+                    api_client=client,
+                    rep_rap_api=rep_rap_api,
+                    camera=MJPEG(),
+                    rate_limiter=RateLimiter(config=settings.get("rate_limits"), path=None, clock=clock),
+                    clock=clock
+                )
+
+    timings = []
+    cycles = 0
+    for record in records:
+        response = record.get('response') or {}
+        if response.get('statusCode') != 200:
+            continue
+        clock.set(record.get('t', clock()))
+        start = perf_counter()
+        handler._handle_buffer(
+                    score=response.get("score"),
+                    smas=response.get("smas")[0],
+                    levels=response.get("levels")
+            )
+        await handler._handle_action()
+        timings.append(perf_counter() - start)
+        await handler._drain()
+        cycles += 1
+
+    return {
+        'cycles' : cycles,
+        'duration' : records[-1].get('t', 0.0) - records[0].get('t', 0.0) if len(records) > 0 else 0.0,
+        'notifications' : [n for n in client.notifications if n[1] == 'warning'],
+        'actions' : rep_rap_api.pauses,
+        'decision_us' : {
+            'mean' : 1e6 * sum(timings) / len(timings) if len(timings) > 0 else 0.0,
+            'p50' : 1e6 * (percentile(timings, 50) or 0.0),
+            'p99' : 1e6 * (percentile(timings, 99) or 0.0)
+        }
+    }
+
+
+def replay_sessions(paths : list, settings : dict = None) -> dict:
+    '''
+    Replays many sessions and summarises the trigger behaviour
+
+    Inputs:
+    - paths : list - session files
+    - settings : dict - settings to evaluate
+
+    Returns:
+    - summary : dict - per-session results and totals
+    '''
+    start = perf_counter()
+    sessions = {}
+    for path in paths:
+        records = load_session(path)
+        sessions[path] = asyncio.run(replay_session(records, settings))
+    wall = perf_counter() - start
+    cycles = sum(r['cycles'] for r in sessions.values())
+    duration = sum(r['duration'] for r in sessions.values())
+    return {
+        'sessions' : sessions,
+        'cycles' : cycles,
+        'notifications' : sum(len(r['notifications']) for r in sessions.values()),
+        'actions' : sum(len(r['actions']) for r in sessions.values()),
+        'sessions_with_action' : sum(1 for r in sessions.values() if len(r['actions']) > 0),
+        'wall_seconds' : wall,
+        'cycles_per_second' : cycles / wall if wall > 0 else 0.0,
+        'speedup' : duration / wall if wall > 0 else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded PrintWatch sessions')
+    parser.add_argument('paths', nargs='+', help='session files or glob patterns')
+    parser.add_argument('--buffer_length', type=int, default=None)
+    parser.add_argument('--buffer_percent', type=float, default=None)
+    parser.add_argument('--notification_threshold', type=float, default=None)
+    parser.add_argument('--action_threshold', type=float, default=None)
+    parser.add_argument('--local_levels', action='store_true', help='recompute the levels locally instead of using the recorded ones')
+    parser.add_argument('--settings', type=str, default=None, help='settings.json to start from')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    settings = deepcopy(REPLAY_SETTINGS)
+    if args.settings is not None:
+        with open(args.settings, "r") as f:
+            settings.update(ujson.load(f))
+    if args.buffer_length is not None:
+        settings["buffer_length"] = args.buffer_length
+    if args.buffer_percent is not None:
+        settings["buffer_percent"] = args.buffer_percent
+    if args.notification_threshold is not None:
+        settings["thresholds"]["notification"] = args.notification_threshold
+    if args.action_threshold is not None:
+        settings["thresholds"]["action"] = args.action_threshold
+    if args.local_levels:
+        settings["level_source"] = "local"
+
+    paths = []
+    for pattern in args.paths:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    summary = replay_sessions(paths, settings)
+    if args.verbose:
+        for path, result in summary['sessions'].items():
+            print('{} | cycles: {} | notifications: {} | actions: {} | decision mean: {:.1f} us'.format(
+                path,
+                result['cycles'],
+                len(result['notifications']),
+                len(result['actions']),
+                result['decision_us']['mean']
+            ))
+    print('Sessions: {} | cycles: {} | notifications: {} | actions: {} ({} sessions)'.format(
+        len(summary['sessions']),
+        summary['cycles'],
+        summary['notifications'],
+        summary['actions'],
+        summary['sessions_with_action']
+    ))
+    print('Replayed in {:.2f}s | {:.0f} cycles/s | {:.0f}x real time'.format(
+        summary['wall_seconds'],
+        summary['cycles_per_second'],
+        summary['speedup']
+    ))
+
+
+if __name__ == '__main__':
+    main()
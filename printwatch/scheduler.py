@@ -0,0 +1,200 @@
+from .utils import LoopHandler
+from .ratelimit import TokenBucket
+from collections import deque
+from time import monotonic
+import asyncio
+import heapq
+import numpy as np
+
+SCHEDULER_SETTINGS = {
+    "adaptive" : False,
+    "min_interval" : 5.0,
+    "max_interval" : 60.0,
+    "max_concurrent" : 2,
+    "calls_per_minute" : 12.0,
+    "burst" : 4
+}
+
+def printer_risk(loop_handler : LoopHandler, window : int = 8) -> float:
+    '''
+    Estimates how urgently a printer needs to be checked
+
+    Inputs:
+    - loop_handler : LoopHandler - the printer's monitor
+    - window : int - number of recent scores used for the trend
+
+    Returns:
+    - risk : float - 0.0 (idle or clean) to 1.0 (action level raised)
+    '''
+    if not loop_handler.printing:
+        return 0.0
+    levels = loop_handler._levels
+    if levels[1]:
+        return 1.0
+    threshold = max(loop_handler.settings.get("thresholds", {}).get("notification", 0.3), 1e-3)
+    recent = np.asarray([s if s is not None else 0.0 for s in loop_handler._scores[-window:]], dtype=np.float64)
+    proximity = float(np.clip(recent.mean() / threshold, 0.0, 1.0)) if len(recent) > 0 else 0.0
+    trend = 0.0
+    if len(recent) >= 3:
+        slope = np.polyfit(np.arange(len(recent)), recent, 1)[0]
+        trend = float(np.clip(slope * len(recent) / threshold, 0.0, 1.0))
+    risk = 0.6 * proximity + 0.4 * trend
+    if levels[0]:
+        risk = max(risk, 0.7)
+    return risk
+
+
+class ScheduledMonitor:
+    '''
+    A printer registered with the InferenceScheduler. Exposes the same
+    _loop_handler / cancel() interface as Scheduler.
+    '''
+    def __init__(self, scheduler, loop_handler : LoopHandler, name : str = ''):
+        self._scheduler = scheduler
+        self._loop_handler = loop_handler
+        self.name = name
+        self.active = True
+        self.risk = 0.0
+        self.interval = 0.0
+        self.last_check = 0.0
+        self._checks = deque(maxlen=32)
+
+    def effective_rate(self) -> float:
+        '''
+        Returns the measured number of checks per minute over the recent history
+        '''
+        if len(self._checks) < 2 or self._checks[-1] <= self._checks[0]:
+            return 0.0
+        return 60.0 * (len(self._checks) - 1) / (self._checks[-1] - self._checks[0])
+
+    def cancel(self):
+        self._scheduler.remove(self)
+
+    def status(self) -> dict:
+        return {
+            'risk' : round(self.risk, 3),
+            'interval' : round(self.interval, 2),
+            'checks_per_minute' : round(self.effective_rate(), 2),
+            'since_last_check' : round(monotonic() - self.last_check, 2) if self.last_check > 0 else None
+        }
+
+
+class InferenceScheduler:
+    '''
+    Shares one inference budget between several printers. Printers are kept in
+    a priority queue ordered by when they are next due. The interval of each
+    printer shrinks as its risk (score trend, raised levels) grows, and slots are
+    handed out under a global rate and concurrency limit.
+    '''
+    def __init__(
+            self,
+            min_interval : float = 5.0,
+            max_interval : float = 60.0,
+            max_concurrent : int = 2,
+            calls_per_minute : float = 12.0,
+            burst : int = 4,
+            **kwargs
+        ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._budget = TokenBucket(capacity=burst, refill_interval=60.0 / calls_per_minute)
+        self._queue = []
+        self._counter = 0
+        self._monitors = []
+        self._wake = asyncio.Event()
+        self._run = True
+        self.task = asyncio.ensure_future(self._run_loop())
+
+    def _interval(self, risk : float) -> float:
+        return self.max_interval - risk * (self.max_interval - self.min_interval)
+
+    def _push(self, monitor : ScheduledMonitor, due : float):
+        self._counter += 1
+        heapq.heappush(self._queue, (due, self._counter, monitor))
+        self._wake.set()
+
+    def add(self, loop_handler : LoopHandler, name : str = '') -> ScheduledMonitor:
+        '''
+        Registers a printer. Its first check is scheduled immediately.
+
+        Inputs:
+        - loop_handler : LoopHandler - the printer's monitor
+        - name : str - identifier used in the status report
+
+        Returns:
+        - monitor : ScheduledMonitor - handle used to inspect or cancel the printer
+        '''
+        monitor = ScheduledMonitor(self, loop_handler, name)
+        self._monitors.append(monitor)
+        self._push(monitor, monotonic())
+        return monitor
+
+    def remove(self, monitor : ScheduledMonitor):
+        monitor.active = False
+        if monitor in self._monitors:
+            self._monitors.remove(monitor)
+
+    async def _check(self, monitor : ScheduledMonitor):
+        try:
+            await monitor._loop_handler._run_once()
+        except Exception as e:
+            print('InferenceScheduler = {}'.format(str(e)))
+        finally:
+            self._semaphore.release()
+            now = monotonic()
+            monitor.last_check = now
+            monitor._checks.append(now)
+            if monitor.active:
+                monitor.risk = printer_risk(monitor._loop_handler)
+                monitor.interval = self._interval(monitor.risk)
+                self._push(monitor, now + monitor.interval)
+
+    async def _sleep(self, delay : float):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0.0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run_loop(self):
+        '''
+        Hands out inference slots to the most overdue printer while the
+        rate and concurrency budgets allow it.
+        '''
+        try:
+            while self._run:
+                while len(self._queue) > 0 and not self._queue[0][2].active:
+                    heapq.heappop(self._queue)
+                if len(self._queue) == 0:
+                    await self._sleep(self.max_interval)
+                    continue
+                due = self._queue[0][0]
+                now = monotonic()
+                if due > now:
+                    await self._sleep(due - now)
+                    continue
+                if not self._budget.available(now):
+                    await self._sleep(self._budget.refill_interval * (1.0 - self._budget.tokens))
+                    continue
+                await self._semaphore.acquire()
+                _, _, monitor = heapq.heappop(self._queue)
+                if not monitor.active:
+                    self._semaphore.release()
+                    continue
+                self._budget.consume(monotonic())
+                asyncio.ensure_future(self._check(monitor))
+        except asyncio.CancelledError:
+            print("Cancelled")
+            raise
+
+    def cancel(self):
+        self._run = False
+        self.task.cancel()
+
+    def status(self) -> dict:
+        return {
+            'queued' : len(self._queue),
+            'budget_tokens' : round(self._budget.tokens, 2),
+            'printers' : {monitor.name or str(idx) : monitor.status() for idx, monitor in enumerate(self._monitors)}
+        }
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+'''
+Offline fleet load simulator. Starts the stand-in servers in a separate
+process, runs N printer monitors (LoopHandler + Scheduler, or the shared
+InferenceScheduler) against them and reports cycle throughput, latency
+percentiles, CPU and memory of the monitoring process as N scales.
+
+Usage:
+    python3 -m printwatch.simulator.driver --printers 1,4,16,64 --duration 30 --interval 1.0
+'''
+from ..client import PrintWatchClient
+from ..interface import MJPEG
+from ..utils import RepRapAPI, LoopHandler, Scheduler
+from ..scheduler import InferenceScheduler, SCHEDULER_SETTINGS
+from ..ratelimit import RateLimiter, RATE_LIMITS
+from ..preview import PreviewCache
+from ..metrics import LatencyHistogram, percentile
+from ..memory import rss_bytes
+from ..watchdog import LoopWatchdog
+from .servers import run_fleet, SIM_SETTINGS
+from copy import deepcopy
+from time import perf_counter, process_time
+import multiprocessing
+import argparse
+import asyncio
+
+PRINTER_SETTINGS = {
+    "api_key" : "simulated",
+    "email_addr" : "",
+    "test_mode" : False,
+    "thresholds" : {
+        "notification" : 0.3,
+        "action" : 0.6,
+        "display" : 0.6
+    },
+    "buffer_length" : 16,
+    "buffer_percent" : 60,
+    "actions": {
+        "pause" : True,
+        "cancel" : False,
+        "notify" : True,
+        "extruder_off" : False,
+        "macro" : False
+    },
+    "rate_limits" : RATE_LIMITS
+}
+
+class SimulatedPrinter:
+    '''
+    One monitor wired to its stand-in Duet and camera, with cycle timing
+    '''
+    def __init__(self, index : int, host : str, base_port : int, preview_cache : PreviewCache, settings : dict = None):
+        self.settings = deepcopy(PRINTER_SETTINGS)
+        self.settings.update(settings or {})
+        self.settings["printer_id"] = 'SIM{:04d}'.format(index)
+        self.settings["duet_ip"] = '{}:{}'.format(host, base_port + 1 + 2 * index)
+        self.settings["camera_ip"] = 'http://{}:{}/snapshot'.format(host, base_port + 2 + 2 * index)
+        self.client = PrintWatchClient(settings=self.settings, route='http://{}:{}'.format(host, base_port))
+        self.rep_rap_api = RepRapAPI(url=self.settings["duet_ip"])
+        self.loop_handler = LoopHandler(
+                                settings=self.settings,
+                                api_client=self.client,
+                                rep_rap_api=self.rep_rap_api,
+                                camera=MJPEG(ip=self.settings["camera_ip"]),
+                                preview_cache=preview_cache,
+                                rate_limiter=RateLimiter(config=self.settings["rate_limits"], path=None)
+                            )
+        self.cycles = LatencyHistogram(buckets=[0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0], window=4096)
+        self.inferences = 0
+        self.errors = 0
+        self._wrap()
+
+    def _wrap(self):
+        run_once = self.loop_handler._run_once
+        send_async = self.client._send_async
+
+        async def timed_run_once():
+            start = perf_counter()
+            await run_once()
+            self.cycles.observe(perf_counter() - start)
+
+        async def counted_send_async(endpoint, payload):
+            try:
+                response = await send_async(endpoint, payload)
+            except Exception:
+                self.errors += 1
+                raise
+            if endpoint == 'api/v2/infer':
+                if response.get('statusCode') == 200:
+                    self.inferences += 1
+                else:
+                    self.errors += 1
+            return response
+
+        self.loop_handler._run_once = timed_run_once
+        self.client._send_async = counted_send_async
+
+
+async def drive(
+        printers : int,
+        duration : float,
+        interval : float,
+        host : str,
+        base_port : int,
+        adaptive : bool = False
+    ) -> dict:
+    '''
+    Runs the simulated fleet for a fixed duration
+
+    Returns:
+    - result : dict - throughput, latency, CPU and memory figures
+    '''
+    loop = asyncio.get_running_loop()
+    watchdog = LoopWatchdog(loop, interval=0.1, threshold=0.25)
+    watchdog.start()
+    preview_cache = PreviewCache()
+    fleet = [SimulatedPrinter(i, host, base_port, preview_cache) for i in range(printers)]
+
+    if adaptive:
+        scheduling = dict(SCHEDULER_SETTINGS)
+        scheduling.update({
+            "min_interval" : interval / 2,
+            "max_interval" : interval * 6,
+            "max_concurrent" : max(2, printers // 2),
+            "calls_per_minute" : 60.0 * printers / interval,
+            "burst" : printers
+        })
+        scheduler = InferenceScheduler(**scheduling)
+        runners = [scheduler.add(printer.loop_handler, printer.settings["printer_id"]) for printer in fleet]
+    else:
+        scheduler = None
+        runners = [Scheduler(interval=interval, loop_handler=printer.loop_handler) for printer in fleet]
+
+    cpu_start = process_time()
+    wall_start = perf_counter()
+    peak_rss = rss_bytes() or 0
+    while perf_counter() - wall_start < duration:
+        await asyncio.sleep(min(1.0, duration))
+        peak_rss = max(peak_rss, rss_bytes() or 0)
+    wall = perf_counter() - wall_start
+    cpu = process_time() - cpu_start
+
+    for runner in runners:
+        runner.cancel()
+    if scheduler is not None:
+        scheduler.cancel()
+    watchdog.stop()
+    await asyncio.sleep(0)
+    for printer in fleet:
+        await printer.rep_rap_api.close()
+
+    samples = []
+    for printer in fleet:
+        samples.extend(printer.cycles._recent)
+
+    return {
+        'printers' : printers,
+        'cycles' : sum(p.cycles.count for p in fleet),
+        'inferences' : sum(p.inferences for p in fleet),
+        'errors' : sum(p.errors for p in fleet),
+        'cycles_per_second' : sum(p.cycles.count for p in fleet) / wall,
+        'cycle_p50' : percentile(samples, 50),
+        'cycle_p90' : percentile(samples, 90),
+        'cycle_p99' : percentile(samples, 99),
+        'cpu_percent' : 100.0 * cpu / wall,
+        'peak_rss_mb' : peak_rss / (1024 * 1024),
+        'loop_lag_p99' : watchdog.status()['lag']['p99']
+    }
+
+
+def simulate(
+        printers : int,
+        duration : float = 30.0,
+        interval : float = 1.0,
+        host : str = '127.0.0.1',
+        base_port : int = 19000,
+        adaptive : bool = False,
+        sim_settings : dict = None
+    ) -> dict:
+    '''
+    Starts the stand-in servers for N printers in a child process and drives them
+
+    Returns:
+    - result : dict - as returned by drive
+    '''
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    stop = context.Event()
+    process = context.Process(target=run_fleet, args=(printers, host, base_port, sim_settings or {}, ready, stop), daemon=True)
+    process.start()
+    try:
+        if not ready.wait(60.0):
+            raise RuntimeError('Simulated servers did not start')
+        return asyncio.run(drive(printers, duration, interval, host, base_port, adaptive))
+    finally:
+        stop.set()
+        process.join(10.0)
+        if process.is_alive():
+            process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PrintWatch offline fleet load simulator')
+    parser.add_argument('--printers', type=str, default='1,4,16', help='comma separated fleet sizes')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds per fleet size')
+    parser.add_argument('--interval', type=float, default=1.0, help='monitor interval in seconds')
+    parser.add_argument('--adaptive', action='store_true', help='use the shared InferenceScheduler')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--base_port', type=int, default=19000)
+    parser.add_argument('--latency', type=float, default=SIM_SETTINGS["latency"])
+    parser.add_argument('--cloud_latency', type=float, default=SIM_SETTINGS["cloud_latency"])
+    parser.add_argument('--failure_rate', type=float, default=SIM_SETTINGS["failure_rate"])
+    parser.add_argument('--cloud_failure_rate', type=float, default=SIM_SETTINGS["cloud_failure_rate"])
+    parser.add_argument('--script', type=str, default=SIM_SETTINGS["script"], help='clean or spaghetti')
+    args = parser.parse_args()
+
+    sim_settings = {
+        "latency" : args.latency,
+        "cloud_latency" : args.cloud_latency,
+        "failure_rate" : args.failure_rate,
+        "cloud_failure_rate" : args.cloud_failure_rate,
+        "script" : args.script
+    }
+    print('{:>8} | {:>7} | {:>9} | {:>8} | {:>8} | {:>8} | {:>6} | {:>7} | {:>8} | {:>6}'.format(
+        'printers', 'cycles', 'cycles/s', 'p50 ms', 'p90 ms', 'p99 ms', 'cpu %', 'rss MB', 'lag ms', 'errors'
+    ))
+    for printers in [int(n) for n in args.printers.split(',')]:
+        result = simulate(printers, args.duration, args.interval, args.host, args.base_port, args.adaptive, sim_settings)
+        print('{:>8} | {:>7} | {:>9.2f} | {:>8.1f} | {:>8.1f} | {:>8.1f} | {:>6.1f} | {:>7.1f} | {:>8.1f} | {:>6}'.format(
+            result['printers'],
+            result['cycles'],
+            result['cycles_per_second'],
+            1e3 * (result['cycle_p50'] or 0.0),
+            1e3 * (result['cycle_p90'] or 0.0),
+            1e3 * (result['cycle_p99'] or 0.0),
+            result['cpu_percent'],
+            result['peak_rss_mb'],
+            1e3 * (result['loop_lag_p99'] or 0.0),
+            result['errors']
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+'''
+Local aiohttp stand-ins for the services a PrintWatch monitor talks to:
+RepRapFirmware (/rr_status, /rr_model, /rr_gcode), a ustreamer camera
+(/snapshot, /stream) and the PrintWatch cloud (/api/v2/infer, /api/v2/notify).
+
+Every endpoint takes a configurable latency, jitter and failure rate, and
+the cloud follows a per-printer score script.
+'''
+from ..levels import LevelEngine
+from aiohttp import web
+from io import BytesIO
+import PIL.Image as Image
+import numpy as np
+import asyncio
+import random
+
+SIM_SETTINGS = {
+    "latency" : 0.02, # seconds
+    "jitter" : 0.01,
+    "failure_rate" : 0.0,
+    "cloud_latency" : 0.3,
+    "cloud_jitter" : 0.1,
+    "cloud_failure_rate" : 0.0,
+    "frame_size" : [1280, 720],
+    "frames" : 4,
+    "script" : "clean", # clean, spaghetti or a list of scores
+    "spaghetti_after" : 30, # cycles before the spaghetti script starts rising
+    "resume_after" : 5.0 # seconds a paused printer waits before printing again
+}
+
+def synthetic_frames(width : int, height : int, count : int = 4, seed : int = 0) -> list:
+    '''
+    Generates JPEG frames with gradients and sensor-like noise so their
+    encoded size is close to a real camera frame.
+    '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(count):
+        img = np.stack([(x / 8 + i * 7) % 255, (y / 5) % 255, ((x + y) / 9) % 255], -1)
+        img = img + rng.normal(0, 12, (height, width, 3))
+        out = BytesIO()
+        Image.fromarray(np.clip(img, 0, 255).astype('uint8')).save(out, format='JPEG', quality=85)
+        frames.append(out.getvalue())
+    return frames
+
+def script_score(script, cycle : int, spaghetti_after : int = 30) -> float:
+    '''
+    Returns the score the simulated model reports for a printer at a given cycle
+    '''
+    if isinstance(script, list):
+        return float(script[cycle % len(script)]) if len(script) > 0 else 0.0
+    noise = random.uniform(0.0, 0.05)
+    if script == 'spaghetti' and cycle >= spaghetti_after:
+        return min(1.0, 0.05 * (cycle - spaghetti_after) + noise)
+    return noise
+
+
+class SimulatedEndpoint:
+    '''
+    Base class adding latency and random failures to request handlers
+    '''
+    def __init__(self, latency : float, jitter : float, failure_rate : float):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+
+    async def _delay(self) -> bool:
+        '''
+        Sleeps for the simulated latency
+
+        Returns:
+        - fail : Boolean - whether this request should fail
+        '''
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+
+class DuetServer(SimulatedEndpoint):
+    '''
+    RepRapFirmware stand-in. Reports printing until a pause G-code is received,
+    then paused for resume_after seconds.
+    '''
+    def __init__(self, unique_id : str, latency : float = 0.02, jitter : float = 0.01, failure_rate : float = 0.0, resume_after : float = 5.0):
+        super().__init__(latency, jitter, failure_rate)
+        self.unique_id = unique_id
+        self.resume_after = resume_after
+        self.status = 'P'
+        self.pauses = 0
+        self._paused_at = 0.0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/rr_status', self.rr_status)
+        app.router.add_get('/rr_model', self.rr_model)
+        app.router.add_get('/rr_gcode', self.rr_gcode)
+        return app
+
+    async def rr_status(self, request):
+        if await self._delay():
+            return web.Response(status=500)
+        loop = asyncio.get_running_loop()
+        if self.status == 'A' and loop.time() - self._paused_at > self.resume_after:
+            self.status = 'P'
+        return web.json_response({'status' : self.status})
+
+    async def rr_model(self, request):
+        if await self._delay():
+            return web.Response(status=500)
+        return web.json_response({'key' : 'boards', 'result' : [{'uniqueId' : self.unique_id}]})
+
+    async def rr_gcode(self, request):
+        if await self._delay():
+            return web.Response(status=500)
+        if request.query.get('gcode', '').upper() == 'M25':
+            self.status = 'A'
+            self.pauses += 1
+            self._paused_at = asyncio.get_running_loop().time()
+        return web.json_response({'buff' : 255})
+
+
+class CameraServer(SimulatedEndpoint):
+    '''
+    ustreamer stand-in serving synthetic JPEG snapshots and an MJPEG stream
+    '''
+    def __init__(self, frames : list, latency : float = 0.02, jitter : float = 0.01, failure_rate : float = 0.0):
+        super().__init__(latency, jitter, failure_rate)
+        self.frames = frames
+        self._index = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/snapshot', self.snapshot)
+        app.router.add_get('/stream', self.stream)
+        return app
+
+    def _next_frame(self) -> bytes:
+        self._index = (self._index + 1) % len(self.frames)
+        return self.frames[self._index]
+
+    async def snapshot(self, request):
+        if await self._delay():
+            return web.Response(status=503)
+        return web.Response(body=self._next_frame(), content_type='image/jpeg')
+
+    async def stream(self, request):
+        response = web.StreamResponse()
+        response.content_type = 'multipart/x-mixed-replace;boundary=boundarydonotcross'
+        await response.prepare(request)
+        try:
+            while True:
+                frame = self._next_frame()
+                await response.write(
+                    b'--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                    + str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n'
+                )
+                await asyncio.sleep(1.0 / 15)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+
+
+class CloudServer(SimulatedEndpoint):
+    '''
+    PrintWatch API stand-in. Scores follow each printer's script and the
+    SMAs and levels are computed with the local LevelEngine from the
+    settings sent in the payload.
+    '''
+    def __init__(self, scripts : dict, latency : float = 0.3, jitter : float = 0.1, failure_rate : float = 0.0, spaghetti_after : int = 30):
+        super().__init__(latency, jitter, failure_rate)
+        self.scripts = scripts
+        self.spaghetti_after = spaghetti_after
+        self.cycles = {}
+        self.engines = {}
+        self.notifications = 0
+        self.bytes_received = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post('/api/v2/infer', self.infer)
+        app.router.add_post('/api/v2/notify', self.notify)
+        return app
+
+    def _engine(self, printer_id : str, payload : dict) -> LevelEngine:
+        if printer_id not in self.engines:
+            thresholds = payload.get('thresholds') or [0.3, 0.6]
+            self.engines[printer_id] = LevelEngine({
+                "buffer_length" : payload.get('buffer_length') or 16,
+                "buffer_percent" : payload.get('buffer_percent') or 60,
+                "thresholds" : {"notification" : thresholds[0], "action" : thresholds[1]}
+            })
+        return self.engines[printer_id]
+
+    async def infer(self, request):
+        body = await request.read()
+        self.bytes_received += len(body)
+        if await self._delay():
+            return web.json_response({'statusCode' : 500, 'response' : 'Simulated failure'})
+        payload = await request.json()
+        printer_id = payload.get('printer_id') or ''
+        cycle = self.cycles.get(printer_id, 0)
+        self.cycles[printer_id] = cycle + 1
+        score = script_score(self.scripts.get(printer_id, 'clean'), cycle, self.spaghetti_after)
+        engine = self._engine(printer_id, payload)
+        levels = engine.update(score)
+        boxes = [[200, 200, 200 + 200 * score, 200 + 200 * score, score]] if score > 0.3 else []
+        return web.json_response({
+            'statusCode' : 200,
+            'score' : score,
+            'smas' : [[0, engine.sma, 0]],
+            'levels' : levels,
+            'boxes' : boxes
+        })
+
+    async def notify(self, request):
+        if await self._delay():
+            return web.json_response({'statusCode' : 500, 'response' : 'Simulated failure'})
+        self.notifications += 1
+        return web.json_response({'statusCode' : 200})
+
+
+async def start_app(app : web.Application, host : str, port : int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def serve_fleet(
+        printers : int,
+        host : str = '127.0.0.1',
+        base_port : int = 19000,
+        settings : dict = None,
+        ready = None,
+        stop = None
+    ):
+    '''
+    Starts one Duet and one camera stand-in per printer and a shared cloud stand-in
+
+    Ports:
+    - cloud : base_port
+    - printer i Duet : base_port + 1 + 2 * i
+    - printer i camera : base_port + 2 + 2 * i
+
+    Inputs:
+    - printers : int - number of simulated printers
+    - host : str - interface to listen on
+    - base_port : int - first port used
+    - settings : dict - overrides of SIM_SETTINGS
+    - ready : multiprocessing.Event - set once all servers listen
+    - stop : multiprocessing.Event - stops the servers when set, runs forever if None
+    '''
+    config = dict(SIM_SETTINGS)
+    config.update(settings or {})
+    frames = synthetic_frames(config["frame_size"][0], config["frame_size"][1], config["frames"])
+    scripts = {'SIM{:04d}'.format(i) : config["script"] for i in range(printers)}
+    cloud = CloudServer(
+                scripts,
+                latency=config["cloud_latency"],
+                jitter=config["cloud_jitter"],
+                failure_rate=config["cloud_failure_rate"],
+                spaghetti_after=config["spaghetti_after"]
+            )
+    runners = [await start_app(cloud.app(), host, base_port)]
+    for i in range(printers):
+        duet = DuetServer(
+                    'SIM{:04d}'.format(i),
+                    latency=config["latency"],
+                    jitter=config["jitter"],
+                    failure_rate=config["failure_rate"],
+                    resume_after=config["resume_after"]
+                )
+        camera = CameraServer(frames, latency=config["latency"], jitter=config["jitter"], failure_rate=config["failure_rate"])
+        runners.append(await start_app(duet.app(), host, base_port + 1 + 2 * i))
+        runners.append(await start_app(camera.app(), host, base_port + 2 + 2 * i))
+    if ready is not None:
+        ready.set()
+    try:
+        while stop is None or not stop.is_set():
+            await asyncio.sleep(0.2)
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def run_fleet(printers : int, host : str, base_port : int, settings : dict, ready = None, stop = None):
+    '''
+    Process entry point for serve_fleet
+    '''
+    asyncio.run(serve_fleet(printers, host, base_port, settings, ready, stop))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run PrintWatch stand-in servers')
+    parser.add_argument('--printers', type=int, default=1)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--base_port', type=int, default=19000)
+    parser.add_argument('--script', type=str, default='clean')
+    args = parser.parse_args()
+    print('Cloud on {}:{}, printer i on ports {} + 2i (Duet) and {} + 2i (camera)'.format(args.host, args.base_port, args.base_port + 1, args.base_port + 2))
+    run_fleet(args.printers, args.host, args.base_port, {"script" : args.script})
@@ -1,7 +1,14 @@
 from .client import PrintWatchClient
 from .interface import MJPEG
-from typing import List
-from time import time
+from .breaker import CircuitBreaker
+from .ratelimit import RateLimiter
+from .preview import PreviewCache
+from .levels import LevelEngine
+from .composite import split_boxes, boxes_to_frame
+from .encoder import prepare_upload, MODEL_SIZE, UPLOAD_QUALITY
+from .metrics import LatencyHistogram
+from typing import List, Union
+from time import time, monotonic, perf_counter
 from base64 import b64encode
 from uuid import uuid4
 import asyncio
@@ -27,9 +34,12 @@ DUET_STATES = {
     "R" : "Resuming", #Resuming a paused print
     "H" : "Halt", # Halt after E-Stop
     "F" : "Flashing", # Flashing new firmware
-    "T" : "Toolchange"
+    "T" : "Toolchange",
+    "A" : "Paused"
 }
 
+PAUSED_STATES = ["D", "S", "A"] # Pausing, paused (older firmware), paused
+
 def get_camera_struct(request) -> list:
     '''
     Returns the cameraStructure from a request
@@ -117,6 +127,8 @@ class RepRapAPI:
         self.url = url
         self.uniqueId = ''
         self.uniqueIdFromRR = False
+        self.breaker = CircuitBreaker(name='duet')
+        self._session = None
         self._get_uid()
 
     def set_url(self, url):
@@ -125,6 +137,23 @@ class RepRapAPI:
             return True
         return False
 
+    def _get_session(self) -> aiohttp.ClientSession:
+        '''
+        Returns the persistent session shared by status polling and G-code
+        commands. Regular status polls keep its connection warm so a pause
+        does not pay for a new TCP connection.
+        '''
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                                connector=aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=75.0)
+                            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
     def _get_uid(self):
         if self.url != '':
             try:
@@ -154,7 +183,8 @@ class RepRapAPI:
     async def _get_state(
                 self,
                 endpoint : str = '',
-                status_type : int = 3
+                status_type : int = 3,
+                force : bool = False
             ) -> dict:
             '''
             Gets the state of the printer from the RepRap firmware
@@ -162,23 +192,33 @@ class RepRapAPI:
             Inputs:
             - endpoint : str - the endpoint to check the state with.
             - status_type : int - the stype of status response to get. Used with the endpoint /rr_status
+            - force : bool - bypass the circuit breaker and leave its state untouched, used when confirming a pause
 
             Returns:
             - response : dict - RepRap firmware status response
             '''
+            if not force and not self.breaker.allow():
+                return False
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                                    'http://{}{}?type={}'.format(
-                                                            self.url,
-                                                            endpoint,
-                                                            status_type
-                                    ),
-                                    timeout=aiohttp.ClientTimeout(total=1.0)
-                                ) as response:
-                                r = await response.json()
+                async with self._get_session().get(
+                                'http://{}{}?type={}'.format(
+                                                        self.url,
+                                                        endpoint,
+                                                        status_type
+                                ),
+                                timeout=aiohttp.ClientTimeout(total=1.0)
+                            ) as response:
+                            r = await response.json(content_type=None)
+                if not force:
+                    self.breaker.record_success()
                 return r
-            except:
+            except asyncio.CancelledError:
+                if not force:
+                    self.breaker.release()
+                raise
+            except Exception as e:
+                if not force:
+                    self.breaker.record_failure(str(e))
                 return False
 
     async def _pause_print(
@@ -194,8 +234,10 @@ class RepRapAPI:
                 Returns:
                 - response : dict - RepRap firmware pause print command response
                 '''
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
+                # The pause is never fast-failed by the breaker, a stale open
+                # state must not stop us from trying to save the print.
+                try:
+                    async with self._get_session().get(
                                     'http://{}/rr_gcode?gcode={}'.format(
                                                             self.url,
                                                             gcode
@@ -203,8 +245,39 @@ class RepRapAPI:
                                     timeout=aiohttp.ClientTimeout(total=10.0)
                                 ) as response:
                                 r = await response.text()
+                except asyncio.CancelledError:
+                    self.breaker.release()
+                    raise
+                except Exception as e:
+                    self.breaker.record_failure(str(e))
+                    raise
+                self.breaker.record_success()
                 return r
 
+    async def _confirm_pause(
+                    self,
+                    timeout : float = 10.0,
+                    poll_interval : float = 0.25
+                ) -> bool:
+                '''
+                Polls the RepRap firmware until it reports a pausing or paused state
+
+                Inputs:
+                - timeout : float - seconds to wait for the pause to be confirmed
+                - poll_interval : float - seconds between status polls
+
+                Returns:
+                - confirmed : Boolean - whether the firmware reported the pause in time
+                '''
+                deadline = monotonic() + timeout
+                while True:
+                    state = self.parse_state_response(await self._get_state('/rr_status', force=True))
+                    if state in PAUSED_STATES:
+                        return True
+                    if monotonic() + poll_interval > deadline:
+                        return False
+                    await asyncio.sleep(poll_interval)
+
     def parse_state_response(self, response):
         if not isinstance(response , bool):
             state_response = response.get("status")
@@ -276,26 +349,39 @@ class LoopHandler:
             settings : dict,
             api_client : PrintWatchClient,
             rep_rap_api : RepRapAPI,
-            camera : MJPEG,
+            camera : Union[MJPEG, List[MJPEG]],
             MULTIPLIER : float = 4.0,
-            duet_states = DUET_STATES
+            duet_states = DUET_STATES,
+            preview_cache : PreviewCache = None,
+            rate_limiter : RateLimiter = None,
+            recorder = None,
+            clock = time
         ):
         self.settings = settings
         self._api_client = api_client
-        self.camera = camera
+        self.cameras = camera if isinstance(camera, list) else [camera]
+        self.camera = self.cameras[0]
         self.MULTIPLIER = MULTIPLIER
         self._buffer = [[0, 0, 0]] * settings.get("buffer_length")
         self._scores = [0] * int(settings.get("buffer_length") * self.MULTIPLIER)
         self._levels = [False, False] # Corresponds to [Notify, Action]
-        self._actionsSent = 0
-        self._lastAction = 0
-        self._notificationsSent = []
-        self._lastNotification = 0
+        self.clock = clock
+        self._limiter = rate_limiter if rate_limiter is not None else RateLimiter(config=settings.get("rate_limits"), clock=clock)
+        self.recorder = recorder
+        self.level_engine = LevelEngine(settings, MULTIPLIER=MULTIPLIER)
+        self.printing = False
+        self._detected_at = None
+        self._background = set()
+        self.action_latency = {
+            'dispatch' : LatencyHistogram(), # detection to pause G-code acknowledged
+            'confirmed' : LatencyHistogram() # detection to the printer reporting the pause
+        }
+        self.action_unconfirmed = 0
+        self.action_failed = 0
         self.retrigger_valid = False
-        self.notifyTimer = 10.0 * 60.0 # 10 minutes between notifications minimum
         self.duet_states = duet_states
         self.rep_rap_api = rep_rap_api
-        self.currentPreview = None
+        self.preview_cache = preview_cache if preview_cache is not None else PreviewCache()
 
     def resize_buffers(self):
         if len(self._buffer) > self.settings.get("buffer_length"):
@@ -306,24 +392,105 @@ class LoopHandler:
         else:
             self._buffer.extend([[0, 0, 0]] * (self.settings.get("buffer_length") - len(self._buffer)))
             self._scores.extend([0] * (int(self.settings.get("buffer_length") * self.MULTIPLIER) - len(self._scores)))
+        self.level_engine.configure()
+
+    def configure_limits(self):
+        self._limiter.configure(self.settings.get("rate_limits"))
+
+    def set_cameras(self, cameras : List[MJPEG]):
+        '''
+        Replaces the camera list, keeping the existing objects (and their
+        breaker state) for cameras whose id is unchanged.
+
+        Inputs:
+        - cameras : list - MJPEG objects built from the settings
+        '''
+        current = {camera.id : camera for camera in self.cameras}
+        updated = []
+        for camera in cameras:
+            if camera.id in current:
+                current[camera.id].ip = camera.ip
+                current[camera.id].roi = camera.roi
+                current[camera.id].roi_mask = camera.roi_mask
+                camera = current[camera.id]
+            updated.append(camera)
+        if len(updated) > 0:
+            self.cameras = updated
+            self.camera = updated[0]
+
+    def preview_key_for(self, camera : MJPEG) -> str:
+        key = self.settings.get("printer_id") or self.camera.ip
+        return '{}:{}'.format(key, camera.id) if camera.id != '' else key
+
+    def _draw_boxes(self, image, boxes : list, camera : MJPEG = None):
+        '''
+        Stores the frame and its detections in the preview cache.
+        Previews are rendered lazily per requested size.
+
+        Inputs:
+        - image : bytes - the encoded camera frame
+        - boxes : list - detections as [x1, y1, x2, y2] relative to the frame
+        - camera : MJPEG - the camera the frame came from, defaults to the first camera
+        '''
+        camera = camera if camera is not None else self.camera
+        self.preview_cache.update(self.preview_key_for(camera), image, boxes)
 
-    def _draw_boxes(self, image, boxes : list) -> str:
-        pil_img = Image.open(BytesIO(image))
-        process_image = ImageDraw.Draw(pil_img)
-        width, height = pil_img.size
+    async def _capture(self) -> list:
+        '''
+        Captures a frame from every camera concurrently
 
-        for i, det in enumerate(boxes):
-            det = [j / 640 for j in det]
-            x1 = det[0] * width
-            y1 = det[1] * height
-            x2 = det[2] * width
-            y2 = det[3] * height
-            process_image.rectangle([(x1, y1), (x2, y2)], fill=None, outline="red", width=4)
+        Returns:
+        - captures : list - (camera, frame) for each camera that returned a frame
+        '''
+        frames = await asyncio.gather(*[camera.snap() for camera in self.cameras])
+        return [(camera, frame) for camera, frame in zip(self.cameras, frames) if not isinstance(frame, bool)]
 
-        out_img = BytesIO()
-        pil_img.save(out_img, format='PNG')
-        contents = b64encode(out_img.getvalue()).decode('utf8')
-        self.currentPreview = 'data:image/png;charset=utf-8;base64,' + contents.split('\n')[0]
+    async def _compose(self, captures : list) -> tuple:
+        '''
+        Builds the image sent for inference off the event loop. Frames are
+        cropped to their camera's regions of interest, several cameras are
+        tiled into one composite so coverage grows without more API calls,
+        and the result is downscaled to the model input size and re-encoded.
+
+        Inputs:
+        - captures : list - (camera, frame) as returned by _capture
+
+        Returns:
+        - image : bytes - encoded image to upload
+        - layout : list - tile rectangles, None for a single camera
+        - bounds : list - per camera crop bounds, None where not cropped
+        '''
+        regions = [[xywh2xyxy(region) for region in camera.roi] for camera, _ in captures]
+        masks = [camera.roi_mask for camera, _ in captures]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+                        None,
+                        prepare_upload,
+                        [frame for _, frame in captures],
+                        regions,
+                        masks,
+                        self.settings.get("upload_size", MODEL_SIZE),
+                        self.settings.get("upload_quality", UPLOAD_QUALITY)
+                    )
+
+    def _update_previews(self, captures : list, boxes : list, layout : list = None, bounds : list = None):
+        '''
+        Maps the returned boxes back to each source camera's full frame and
+        updates the previews
+
+        Inputs:
+        - captures : list - (camera, frame) that were sent
+        - boxes : list - detections in model input coordinates (MODEL_SIZE x MODEL_SIZE)
+        - layout : list - tile rectangles of the composite, None for a single camera
+        - bounds : list - per camera crop bounds, None where not cropped
+        '''
+        boxes = [[j / MODEL_SIZE for j in det[:4]] for det in boxes or []]
+        per_camera = split_boxes(boxes, layout) if layout is not None else [boxes]
+        bounds = bounds if bounds is not None else [None] * len(captures)
+        for (camera, frame), camera_boxes, camera_bounds in zip(captures, per_camera, bounds):
+            if camera_bounds is not None:
+                camera_boxes = boxes_to_frame(camera_boxes, camera_bounds)
+            self._draw_boxes(frame, camera_boxes, camera)
 
     def _handle_buffer(
                 self,
@@ -333,8 +500,17 @@ class LoopHandler:
         ):
         '''
         Manages the buffer, scores, and levels.
-
+        The levels are taken from the server, the local level engine, or
+        both depending on the level_source setting.
         '''
+        local_levels = self.level_engine.update(score)
+        source = self.settings.get("level_source", "server")
+        if levels is None or source == 'local':
+            levels = local_levels
+        else:
+            self.level_engine.cross_check(levels)
+            if source == 'both':
+                levels = [bool(a or b) for a, b in zip(levels, local_levels)]
 
         self._buffer.append(smas)
         self._scores.append(score)
@@ -361,35 +537,24 @@ class LoopHandler:
         Returns:
         - valid : Boolean - whether a certain trigger should be allowed
         '''
-        if self._actionsSent > 10: # May want to change this for the show
+        if self._limiter['action'].exhausted():
             return False
         if type == 'notify':
-            if self.last_n_notifications_interval() < 2 and self.retrigger_check():
-                return True if len(self._notificationsSent) < 10 and time() - self._lastNotification > self.notifyTimer else False
+            if self._limiter.allow('notify') and self.retrigger_check():
+                return True
             return False
         elif type == 'action':
-            return True if self._actionsSent < 10 and time() - self._lastAction > self.notifyTimer else False
+            return self._limiter.allow('action')
 
-    def last_n_notifications_interval(self, interval : int = 4 * 60 * 60) -> int:
+    def last_n_notifications_interval(self) -> int:
         '''
-        Checks how many notifications have been sent in the last N hours
-
-        Inputs:
-        - interval : int - the interval to check occurences of notifications
+        Checks how many notifications have been sent in the configured
+        notification window (4 hours by default)
 
         Returns:
-        - running_total : int - number of notifications in the last N hours
+        - running_total : int - number of notifications in the window
         '''
-        # 4 hour default interval
-        current_time = time()
-        running_total = 0
-
-        # reverse-order because self._notificationsSent values get appended
-        for idx in reversed(range(len(self._notificationsSent))):
-            if time() - self._notificationsSent[idx] > interval:
-                break
-            running_total += 1
-        return running_total
+        return self._limiter['notify'].window.count(self.clock())
 
     def retrigger_check(self) -> bool:
         '''
@@ -416,12 +581,60 @@ class LoopHandler:
 
 
 
+    def _spawn(self, coro):
+        '''
+        Runs a coroutine in the background, keeping a reference until it completes
+        '''
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _drain(self):
+        '''
+        Waits for the background work (pause confirmation, notifications) to finish
+        '''
+        while len(self._background) > 0:
+            await asyncio.gather(*list(self._background), return_exceptions=True)
+
+    async def _confirm_action(self, detected_at : float):
+        '''
+        Confirms the pause by polling the Duet state and records the
+        detection-to-pause latency.
+
+        Inputs:
+        - detected_at : float - perf_counter() when the detection response arrived
+        '''
+        confirmed = await self.rep_rap_api._confirm_pause()
+        if confirmed:
+            self.action_latency['confirmed'].observe(perf_counter() - detected_at)
+        else:
+            self.action_unconfirmed += 1
+            print("Pause not confirmed by the printer")
+
+    async def _background_notify(self, notification_level : str):
+        '''
+        Sends a notification from the background, reporting failures since
+        nothing awaits the task
+        '''
+        try:
+            response = await _async_notify(
+                                api_client=self._api_client,
+                                notification_level=notification_level
+                            )
+            if response.get('statusCode') != 200:
+                print('Notification not sent: {}'.format(response))
+        except Exception as e:
+            print("Error sending notification: {}".format(str(e)))
+
     async def _handle_action(
             self
         ):
         '''
         Checks if any actions should be taken.
         Notifications and Pauses will be triggered from inside this method.
+        The pause G-code is sent before anything else, its confirmation and the
+        notification run in the background.
         '''
         if self._levels[1] and self._allow_trigger('action') and self.settings.get("actions", {}).get("pause", False):
             # Currently no way of supporting actions via serial.
@@ -429,23 +642,25 @@ class LoopHandler:
             notification_level = 'action'
             if self.settings.get("actions", {}).get("pause", False) or self.settings.get("actions", {}).get("cancel", False):
                 print("SENDING ACTION")
-                # Take the pause action if enabled
-                r = await self.rep_rap_api._pause_print(gcode = 'm25')
-
-                response = await _async_notify(
-                                        api_client=self._api_client,
-                                        notification_level=notification_level
-                                    )
-
-                if response.get('statusCode') == 200:
-                    self._buffer = [0] * self.settings.get("buffer_length")
-                    self._scores = [0] * int(self.settings.get("buffer_length") * self.MULTIPLIER)
-                    self._levels = [False, False]
-                    self._actionsSent += 1
-                    self._lastAction = time()
-                else:
-                    # Retry logic
-                    pass
+                # Take the pause action first, everything else waits for it
+                detected_at = self._detected_at if self._detected_at is not None else perf_counter()
+                try:
+                    r = await self.rep_rap_api._pause_print(gcode = 'M25')
+                except Exception as e:
+                    # Not reset, the action is retried on the next cycle
+                    self.action_failed += 1
+                    print("Error sending pause: {}".format(str(e)))
+                    return
+                self.action_latency['dispatch'].observe(perf_counter() - detected_at)
+
+                self._buffer = [[0, 0, 0]] * self.settings.get("buffer_length")
+                self._scores = [0] * int(self.settings.get("buffer_length") * self.MULTIPLIER)
+                self._levels = [False, False]
+                self.level_engine.reset()
+                self._limiter.record('action')
+
+                self._spawn(self._confirm_action(detected_at))
+                self._spawn(self._background_notify(notification_level))
         elif self._levels[0] and self._allow_trigger('notify'):
             print("Sending Warning via Email")
             notification_level = 'warning'
@@ -454,9 +669,8 @@ class LoopHandler:
                                     api_client=self._api_client,
                                     notification_level=notification_level
                                 )
-            self._lastNotification = time()
             self.retrigger_valid = False
-            self._notificationsSent.append(time())
+            self._limiter.record('notify')
 
 
 
@@ -467,9 +681,12 @@ class LoopHandler:
         try:
             # Add conditional for checking whether print state
             duet_state = await self.rep_rap_api._get_state('/rr_status')
-            if self.rep_rap_api.parse_state_response(duet_state) == 'P' or self.settings.get("test_mode"):
-                frame = self.camera.snap_sync()
-                if not isinstance(frame, bool):
+            state = self.rep_rap_api.parse_state_response(duet_state)
+            self.printing = state == 'P' or bool(self.settings.get("test_mode"))
+            if self.printing:
+                captures = await self._capture()
+                if len(captures) > 0:
+                    frame, layout, bounds = await self._compose(captures)
                     # Get the DUET print state here
                     #print_stats = {}
                     #if self.settings.get("test_mode") and not self.rep_rap_api.parse_state_response(duet_state) == 'P':
@@ -488,17 +705,28 @@ class LoopHandler:
                                         api_client=self._api_client
                                     )
                     if response.get('statusCode') == 200:
-                        self._draw_boxes(frame, response.get('boxes'))
+                        self._detected_at = perf_counter()
                         self._handle_buffer(
                                     score=response.get("score"),
                                     smas=response.get("smas")[0],
                                     levels=response.get("levels")
                             )
                         await self._handle_action()
+                        self._update_previews(captures, response.get('boxes'), layout, bounds)
                     else:
                         print('Response code not 200: {}'.format(response))
+                    if self.recorder is not None:
+                        # gzip and base64 work stays off the event loop
+                        loop = asyncio.get_running_loop()
+                        await loop.run_in_executor(None, self.recorder.record, self.clock(), duet_state, response, frame)
                 else:
                     print("Issue with camera")
+            elif state == 'I':
+                # Only the firmware reporting idle ends the print. Pauses, failed
+                # polls and an open breaker keep the session and caps going.
+                if self.recorder is not None:
+                    self.recorder.end_session()
+                self._limiter.reset()
         except Exception as e:
             print("Exception as e: {}".format(str(e)))
         except Exception as e:
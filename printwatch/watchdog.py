@@ -0,0 +1,117 @@
+from .metrics import LatencyHistogram
+from collections import deque
+from time import perf_counter, time
+import threading
+import traceback
+import sys
+
+WATCHDOG_SETTINGS = {
+    "enabled" : True,
+    "interval" : 0.5, # seconds between lag probes
+    "threshold" : 0.25 # lag in seconds that counts as a stall
+}
+
+class LoopWatchdog:
+    '''
+    Measures the lag of an asyncio event loop from a helper thread.
+    A probe callback is posted to the loop every interval; when it has not
+    run after threshold seconds the loop is considered stalled and the stack
+    of the loop thread is captured to show what is blocking it.
+    '''
+    def __init__(
+            self,
+            loop,
+            interval : float = 0.5,
+            threshold : float = 0.25,
+            history : int = 20,
+            **kwargs
+        ):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = LatencyHistogram(buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0])
+        self.stalls = deque(maxlen=history)
+        self.stall_count = 0
+        self._loop_thread = None
+        self._last_lag = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='printwatch-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _beat(self, posted : float, done : threading.Event):
+        self._last_lag = perf_counter() - posted
+        if self._loop_thread is not None:
+            # The first probe waits for the loop to start running, not a stall
+            self.lag.observe(self._last_lag)
+        self._loop_thread = threading.get_ident()
+        done.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            posted = perf_counter()
+            done = threading.Event()
+            try:
+                self.loop.call_soon_threadsafe(self._beat, posted, done)
+            except RuntimeError:
+                # Loop closed
+                return
+            if not done.wait(self.threshold):
+                report = self._report_stall(posted)
+                while not done.wait(self.interval):
+                    if self._stop.is_set() or self.loop.is_closed():
+                        return
+                if report is not None:
+                    # Replace the lag at detection with the full stall duration
+                    report['lag'] = self._last_lag
+            self._stop.wait(self.interval)
+
+    def _report_stall(self, posted : float):
+        '''
+        Captures and logs the stack of the loop thread while it is blocked
+        '''
+        frame = sys._current_frames().get(self._loop_thread) if self._loop_thread is not None else None
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        # Innermost frame from this package is the most useful culprit,
+        # fall back to the innermost frame overall (e.g. a socket read)
+        offending = stack[-1]
+        for entry in reversed(stack):
+            if '/printwatch/' in entry.filename.replace('\\', '/'):
+                offending = entry
+                break
+        self.stall_count += 1
+        report = {
+            'time' : time(),
+            'lag' : perf_counter() - posted,
+            'function' : '{} ({}:{})'.format(offending.name, offending.filename, offending.lineno),
+            'stack' : traceback.format_list(stack[-12:])
+        }
+        self.stalls.append(report)
+        print("Event loop blocked for {:.2f}s in {}\n{}".format(report['lag'], report['function'], ''.join(report['stack'])))
+        return report
+
+    def status(self) -> dict:
+        lag = self.lag.status()
+        return {
+            'lag' : {
+                'p50' : lag['p50'],
+                'p90' : lag['p90'],
+                'p99' : lag['p99'],
+                'max' : lag['max'],
+                'count' : lag['count']
+            },
+            'stalls' : self.stall_count,
+            'recent_stalls' : [
+                {'time' : s['time'], 'lag' : s['lag'], 'function' : s['function']} for s in self.stalls
+            ]
+        }